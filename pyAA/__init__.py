@@ -23,6 +23,8 @@ __all__ = [ "report_never_connected_pvs",
             "report_storage_rate",
             "report_storage_consumed",
             "report_overflow_pvs",
+            "report_storage_tiers",
+            "verify_lts_files",
             "abort_pvs",
             "pause_pvs",
             "resume_pvs",
@@ -30,4 +32,10 @@ __all__ = [ "report_never_connected_pvs",
             "delete_pvs_and_data",
             "change_pvs_archival_parameters",
             "get_reconnected_pvnames",
+            "tune_overflow_pvs",
+            "export_pvs_data",
+            "audit_pvs_data",
+            "diff_pvs",
+            "snapshot_health",
+            "report_health_changes",
             "ArchiverAppliance"]
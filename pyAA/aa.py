@@ -7,10 +7,18 @@ import os
 import sys
 import time
 import traceback
-import re
+import itertools
 import glob
 from collections import OrderedDict as odict
 from epicsarchiver import ArchiverAppliance
+import export
+import store
+import health
+import purge
+import verify
+import catalog
+import utils
+import output
 
 # get the Archiver's FULL hostname: localhost or hostname defined in aa.conf 
 import socket
@@ -48,41 +56,67 @@ by itself. Make changes on pyAA/aa.conf, then try again.")
 
 print("The long-term storage(lts) path in pyAA/aa.conf is: {}. Please make sure \
 it is correct".format(aaconfig_dict["Lts"]["Path"]))
+# [Sts], [Mts] and [Lts] sections of aa.conf: tier -> path and granularity
+storage_tiers = store.tiers_from_config(aaconfig_dict)
 
 import subprocess
 log_dir = os.path.expanduser("~") + "/aa-script-logs"
 subprocess.call(['mkdir', '-p', log_dir])
 
-def _log(results, file_prefix, one_line_per_pvinfo=True, **kargs):
+# [Output] section of aa.conf: format and compression of the log files
+log_format = aaconfig_dict.get("Output", {}).get("Format", "txt")
+log_compression = aaconfig_dict.get("Output", {}).get("Compression") or None
+
+def _log(results, file_prefix, one_line_per_pvinfo=True, output_format=None, 
+         compression=None, columns=None, **kargs):
     '''Save results, which may include pv names as well as other information, 
-    to a text file. one_line_per_pvinfo makes .txt file more easier to be 
-    analyzied by other software such as Microsoft Excel 
+    to a file in ~/aa-script-logs. results can be a list or any iterable (e.g. 
+    a generator): rows are written incrementally through a buffer. 
+    output_format: 'txt' (legacy, tab separated), 'csv', 'jsonl' or 'parquet' 
+    (default: Format of [Output] in aa.conf, or 'txt'); all rows of a report 
+    have the same columns in csv, jsonl and parquet files. 
+    compression: 'gzip' or 'bz2' (default: Compression of [Output] in aa.conf).
+    columns: the columns of csv, jsonl and parquet files (default: all keys of 
+    the rows if results is a list, else the keys of the first row).
+    one_line_per_pvinfo makes .txt file more easier to be analyzied by other 
+    software such as Microsoft Excel 
     '''
-    if not results:
+    rows = iter(results or [])
+    first = next(rows, None)
+    if first is None:
         print("Nothing to be logged for %s"%file_prefix)
         return
+    fmt = output_format or log_format
+    compression = compression or log_compression
+    if fmt == 'parquet':
+        try:
+            import pyarrow
+        except ImportError:
+            print("pyarrow is not installed: csv is used instead of parquet")
+            (fmt, compression) = ('csv', None)
             
     timestamp = str(time.strftime("-%Y%b%d_%H%M%S"))
     prefix = str(file_prefix).replace(" ", "-")
-    file_name = log_dir + "/" + prefix +'-'+str(len(results)) + timestamp+".txt"
-
-    with open(str(file_name), 'w') as fd:
-        if isinstance(results[0], unicode) or isinstance(results[0], str):
-            for result in results:
-                fd.write(str(result) + "\n")
-        elif isinstance(results[0], odict) or isinstance(results[0], dict):
-            for pv_dict in results:
-                for (k, v) in pv_dict.iteritems():
-                    fd.write(str(k+"\t")+str(v)+"\t")
-                    if not one_line_per_pvinfo:
-                        fd.write("\n")
-                        
-                fd.write("\n")
-
-    print("{} PV items have been written to {}.".format(len(results), file_name))
-    if isinstance(results[0], unicode) or isinstance(results[0], str):
+    partial_name = log_dir + "/" + prefix + timestamp + ".partial"
+    options = {'one_line_per_pvinfo': one_line_per_pvinfo} if fmt == 'txt' else {}
+    if columns is None and isinstance(results, list):
+        columns = output.union_columns(results)
+    try:
+        count = output.write_report(itertools.chain([first], rows), 
+                                    partial_name, fmt, columns=columns, 
+                                    compression=compression, **options)
+    except BaseException:
+        if os.path.exists(partial_name):
+            os.remove(partial_name)
+        raise
+    file_name = log_dir + "/" + prefix +'-'+str(count) + timestamp + \
+                output.extension(fmt, compression)
+    os.rename(partial_name, file_name)
+
+    print("{} PV items have been written to {}.".format(count, file_name))
+    if not isinstance(first, dict):
         print("")
-    if isinstance(results[0], odict) or isinstance(results[0], dict):
+    elif fmt == 'txt':
         print("Use MS Excel or OpenOffice Spreadsheet(Insert Sheet from File ...) \
 to open the txt file above for better viewing. \n")
 
@@ -115,16 +149,8 @@ def _get_pvnames(results, sort=True, do_return=True, **kargs):
 
 def _get_pvnames_from_file(filename='pvlist.txt'):
     '''pvnames in 'filename' should be listed as one column'''
-    with open(filename, "r") as fd:
-        lines = fd.readlines()
-        pvname_list = []
-        for line in lines:
-            line = str(line).strip() # do the stip() first
-            # Remove empty lines and lines that start with "#"            
-            if line.startswith("#") or line == "":
-                continue
-            pvname_list.append(line)
-            
+    # empty lines and lines that start with "#" are skipped
+    pvname_list = [str(line) for line in utils.iter_pvnames_from_file(filename)]
     pvnames = list(set(pvname_list)) # remove duplicated PVs
     pvnames.sort()
     print("get %d PVs from %s"%(len(pvnames), filename))
@@ -133,10 +159,16 @@ def _get_pvnames_from_file(filename='pvlist.txt'):
 
 def _get_pvs_file_info(pvnames, only_report_total_size=True,
                       only_report_current_year=True,
-                      lts_path=str(aaconfig_dict["Lts"]["Path"]), **kargs):
+                      lts_path=str(aaconfig_dict["Lts"]["Path"]), lts_index=None,
+                      all_tiers=False, tier_indexes=None, **kargs):
     '''- Get archived data file name and file size for each pvname in pvnames.
     pvname = "SR-RF{CFD:2-Cav}E:I"; relative_path = 'SR/RF/CFD/2/Cav/E/I';
-    pb_file: lts_path/SR/RF/CFD/2/Cav/E/I:2016.pb. '''
+    pb_file: lts_path/SR/RF/CFD/2/Cav/E/I:2016.pb. 
+    lts_index: optional index built by store.scan_pb_files(lts_path), used 
+    instead of globbing the files of each pv.
+    all_tiers=True: also report the number and size of files in each storage
+    tier of aa.conf (STS, MTS, LTS), scanned in parallel; tier_indexes: 
+    optional indexes built by store.scan_tiers(storage_tiers).'''
     if not os.path.isdir(lts_path):
         print("Aborted: the long-term storage(lts) path '{}:{}' seems not \
 available. Please make sure pyAA is running on the Archiver server. Also please \
@@ -144,6 +176,9 @@ verify settings in pyAA/aa.conf".format(localhost, lts_path))
         sys.exit("Please exit python/ipython shell if the shell does not exit \
 by itself. Make changes on pyAA/aa.conf, then try again.")
 
+    if all_tiers and tier_indexes is None:
+        tier_indexes = store.scan_tiers(storage_tiers, kargs.pop('workers', 8))
+        
     pvs_file_info = []
     zero_size_pvnames = []
     for pvname in pvnames:
@@ -155,11 +190,14 @@ by itself. Make changes on pyAA/aa.conf, then try again.")
         cur_year = str(time.strftime("%Y"))
         pv_file_info[pvname+'('+cur_year+')'] = 0
         # replace the special characters, ':', '{', '}', '-', with '/'
-        relative_path = re.sub('[:{}-]', '/', pvname) #this is specific for NSLS-2
-        #relative_path = re.sub('[char_set]', '/', pvname)
+        relative_path = store.pv_relative_path(pvname) #specific for NSLS-2
         full_path = lts_path + '/' + str(relative_path)
+        if lts_index is not None:
+            pb_files = lts_index.get(os.path.normpath(full_path), [])
+        else:
+            pb_files = glob.glob(full_path+':*')
         
-        for pb_file in glob.glob(full_path+':*'):    
+        for pb_file in pb_files:    
             # .rsplit will fail for a pv like this: "SR{}B-I"        
             #year = "".join("".join(pb_file.rsplit(full_path+':'))).rsplit('.pb')[0]
             year = str(pb_file.split(':')[1]).split('.')[0]
@@ -182,6 +220,12 @@ by itself. Make changes on pyAA/aa.conf, then try again.")
         pv_file_info[pvname+'(path)'] = full_path
         pv_file_info[pvname+'(file_names)'] = file_names
         pv_file_info[pvname+'(years)'] = years
+        for (tier, index) in (tier_indexes or {}).items():
+            tier_files = index.get(os.path.normpath(storage_tiers[tier]["path"]
+                                   + '/' + str(relative_path)), [])
+            pv_file_info[pvname+'('+tier+' files)'] = len(tier_files)
+            pv_file_info[pvname+'('+tier+' total)'] = '{:.9f}'.format(
+                sum(size for (f, size) in tier_files)/(1024.0**3))
 
         pvs_file_info.append(pv_file_info)
 
@@ -201,10 +245,13 @@ def report(report_type="", **kargs):
       6) limit=max-number-of-pvs: for report_storage_rate(), etc.; 
       7) one_line_per_pvinfo: if False, key & value per line in the log file;
       8) sort: if False, pv names are not sorted;
+      9) output_format: 'txt', 'csv', 'jsonl' or 'parquet' for the log files; 
+     10) compression: 'gzip' or 'bz2' for the log files;
     And the following can be used if log_file_info=True: 
         lts_path: very important, you have to set the correct "Path" in aa.conf; 
         only_report_total_size: if False, then all *.pb file sizes are logged; 
-        only_report_current_year: if False, then all .pb file names are logged.'''
+        only_report_current_year: if False, then all .pb file names are logged;
+        all_tiers: if True, file counts and sizes in STS/MTS/LTS are logged.'''
     #print("keyword arguments: {}".format(kargs))
     if report_type == 'never connected':
         results =  archiver.get_never_connected_pvs()
@@ -235,7 +282,8 @@ def report(report_type="", **kargs):
     
     if kargs.pop('log_file_info', False):
         info = _get_pvs_file_info(pvnames, **kargs)
-        _log(info[0], report_type + " pvs file info", **kargs)   
+        _log(info[0], report_type + " pvs file info", 
+             columns=output.file_info_columns(info[0]), **kargs)
         if len(info[1]) > 0: 
             zero_size_pvnames = info[1]
             zero_size_pvnames.sort()
@@ -306,6 +354,58 @@ def report_overflow_pvs(**kargs):
     return report(report_type='overflow', sort=False, **kargs)
         
         
+def report_storage_tiers(pvnames_src=None, workers=8, top=20, do_return=False):
+    '''Report the number and size of .pb files per pv in each storage tier of 
+    aa.conf ([Sts], [Mts], [Lts]); the tiers are scanned at the same time, each
+    with 'workers' threads. The 'top' pvs with the most files in the fast tiers 
+    (STS, MTS) are printed: they are the ones thrashing them.
+    pvnames_src(source where we get pvnames): 
+    1) default is None: all pvs found in the storage (by their relative path);
+    2) a list of pv names: e.g. ['pv1', 'pv2'];
+    3) filename: e.g. '/path/to/pvlist.txt', pvnames should be listed as one column.'''
+    pvnames = None
+    if isinstance(pvnames_src, list):
+        pvnames = pvnames_src
+    elif pvnames_src is not None:
+        pvnames = _get_pvnames_from_file(pvnames_src)
+    
+    started = time.time()
+    indexes = store.scan_tiers(storage_tiers, workers)
+    rows = store.tier_usage(storage_tiers, indexes, pvnames)
+    print("Scanned {} storage tiers in {:.1f} seconds.".format(len(indexes), 
+                                                    time.time() - started))
+    for (tier, (pvs, files, size_GB)) in store.tier_totals(rows).items():
+        print("{} ({}, {}): {} PVs, {} files, {:.3f} GB".format(tier, 
+            storage_tiers[tier]["path"], storage_tiers[tier]["granularity"] or 
+            "unknown granularity", pvs, files, size_GB))
+    fast = [row for row in rows if row["tier"] in ("Sts", "Mts")]
+    fast.sort(key=lambda row: (row["files"], row["size_GB"]), reverse=True)
+    for row in fast[:top]:
+        print("  {} ({}): {} files, {:.3f} GB, {} ... {}".format(row["pvName"], 
+            row["tier"], row["files"], row["size_GB"], row["first"], row["last"]))
+    _log(rows, "storage tiers pvs file info")
+    if do_return:
+        return rows
+
+
+def verify_lts_files(processes=None, resume=True, **kargs):
+    '''Check the integrity of all .pb files in the long-term storage (framing,
+    escaping, header year vs. file name, increasing timestamps inside the 
+    partition) in a pool of 'processes' processes (default: number of CPUs). 
+    Bad files are listed in ~/aa-script-logs/verify-lts/bad_files.tsv; an 
+    interrupted check resumes from its checkpoint and files which have not
+    changed since they were checked are skipped (resume=False checks all).
+    Supported keyword arguments: lts_path (default: [Lts] Path in aa.conf), 
+    out_dir (default: ~/aa-script-logs/verify-lts).'''
+    lts_path = kargs.pop('lts_path', str(aaconfig_dict["Lts"]["Path"]))
+    if not os.path.isdir(lts_path):
+        print("Aborted: the long-term storage(lts) path '{}:{}' seems not \
+available.".format(localhost, lts_path))
+        return
+    return verify.verify_tree(lts_path, kargs.pop('out_dir', log_dir + 
+        "/verify-lts"), processes=processes, resume=resume, **kargs)
+
+
 def _get_authentication():
     try: 
         userID = os.popen('whoami').read()[:-1] 
@@ -317,12 +417,86 @@ by itself. Ask for permission to work on Archiver, then try again.")
         pass # no authentication if no aaconfig_dict["Superusers"]["*"]
 
 
+def _delete_pvs_and_data_by_years(pvnames, start_year=0, end_year=0, 
+                                  confirm=True, dry_run=False, **kargs):
+    '''Pause pvnames, delete their .pb files from start_year to end_year, then
+    delete the pvs (see purge.py): the files are found by a single scan of 
+    the LTS tree, summarized per year, deleted in parallel batches by a single
+    'sudo' helper process, and everything is recorded in a manifest file. 
+    Pvs which cannot be paused, or whose files are still on disk after the 
+    deletion, are kept (paused) in the Archiver. 
+    dry_run=True only prints the summary.'''
+    if start_year > end_year:
+        print("Aborted: start={}>end={}".format(start_year,end_year))
+        return
+    lts_path = kargs.pop('lts_path', str(aaconfig_dict["Lts"]["Path"]))
+    if not os.path.isdir(lts_path):
+        print("Aborted: the long-term storage(lts) path '{}:{}' seems not \
+available.".format(localhost, lts_path))
+        return
+    plan = purge.plan(pvnames, start_year, end_year, lts_path)
+    purge.print_summary(plan)
+    if dry_run or not plan["pvnames"]:
+        return
+    if confirm:
+        answer = raw_input("Do you really wanna delete the files above and the \
+%d PVs? Type yes or no: "%len(plan["pvnames"]))
+        if answer.upper() != "YES":
+            print("Quit. Nothing done.")
+            return 
+        
+    # the manifest is written before anything is deleted, then updated
+    manifest = log_dir + "/delete-manifest" + \
+               str(time.strftime("-%Y%b%d_%H%M%S")) + ".json"
+    details = {"start_year": start_year, "end_year": end_year, 
+               "lts_path": lts_path, "user": os.popen('whoami').read()[:-1]}
+    purge.write_manifest(manifest, plan, state="planned", **details)
+    print("The deletion manifest has been written to %s"%manifest)
+
+    # pause first: the Archiver must not write the files being deleted
+    kept = set(purge.pause_pvs(archiver, plan["pvnames"]))
+    paths = [f["path"] for f in plan["files"] if f["pvName"] not in kept]
+    details["not_paused"] = sorted(kept)
+    purge.write_manifest(manifest, plan, state="deleting files", **details)
+    returncode = purge.delete_files(paths, 
+        batch_size=kargs.pop('batch_size', 500), 
+        processes=kargs.pop('processes', 4))
+    remaining = set(purge.remaining_files(paths))
+    kept.update(f["pvName"] for f in plan["files"] if f["path"] in remaining)
+    details.update(helper_returncode=returncode, 
+                   remaining_files=sorted(remaining))
+    purge.write_manifest(manifest, plan, state="deleting pvs", **details)
+    if returncode != 0 or remaining:
+        print("Warning: the deletion helper returned {}; {} files are still on \
+disk.".format(returncode, len(remaining)))
+    if kept:
+        print("{} PVs which could not be paused or whose files could not be \
+deleted are kept in the Archiver.".format(len(kept)))
+    results = purge.delete_pvs(archiver, 
+        [pv for pv in plan["pvnames"] if pv not in kept], 
+        workers=kargs.pop('workers', 8))
+    results.extend({"pvName": pv, "status": "kept", "validation": "not paused \
+or files not deleted"} for pv in plan["pvnames"] if pv in kept)
+    valid_pvnames = [r['pvName'] for r in results if r.get('status') == 'ok']
+    print("Successfully deleted {} of {} PVs.".format(len(valid_pvnames), 
+                                                      len(plan["pvnames"])))
+    
+    purge.write_manifest(manifest, plan, state="done", results=results, 
+                         **details)
+    print("The deletion manifest has been updated: %s"%manifest)
+    _log(results, "delete_pvs_and_data pv details")
+    _log(valid_pvnames, "delete_pvs_and_data pvnames")
+    return valid_pvnames
+
+
 def _action(pvnames_src=None, act="unknown", **kargs):
     '''perform the action 'act' (abort, pause, resume) on pvs
     pvnames_src(source where we get pvnames): 
     1) optional: default is None; 3 actions supported: abort, pause, resume;
     2) a list of pv names: i.e. ['pv1', 'pv2'];
     3) filename: i.e. 'pause_pvs.txt', pv names should be listed as one column
+    confirm=False skips the interactive confirmation (e.g. pyAA daemon). 
+    Return the pv names on which 'act' was successfully performed.
     '''
     _get_authentication()
     
@@ -344,16 +518,20 @@ def _action(pvnames_src=None, act="unknown", **kargs):
         pvnames = _get_pvnames(pvnames) # sort pv names ... 
     if not pvnames:
         return
+    if act == 'delete_pvs_and_data' and kargs.get('end_year', 0) > 0:
+        # delete files from start_year to end_year
+        return _delete_pvs_and_data_by_years(pvnames, **kargs)
         
-    answer = raw_input("Do you really wanna perform %s? Type yes or no: "%act)
-    if answer.upper() != "YES":
-        print("Quit. Nothing done.")
-        return 
+    if kargs.pop('confirm', True):
+        answer = raw_input("Do you really wanna perform %s? Type yes or no: "%act)
+        if answer.upper() != "YES":
+            print("Quit. Nothing done.")
+            return 
         
     results = []
     valid_pvnames = []
-    start_year = kargs.pop('start_year', 0)
-    end_year = kargs.pop('end_year', 0)
+    kargs.pop('start_year', 0)
+    kargs.pop('end_year', 0)
     for pvname in pvnames:
         if act == 'abort_pvs':
             result = archiver.abort_pv(pvname) 
@@ -366,43 +544,8 @@ def _action(pvnames_src=None, act="unknown", **kargs):
         elif act == 'delete_pvs_only':
             result = archiver.pause_pv(pvname) 
             result = archiver.delete_pv(pvname, delete_data=False) 
-        elif act == 'delete_pvs_and_data':
-            if end_year <= 0: # by default, delete all data
-                result = archiver.delete_pv(pvname, delete_data=True)
-            else: # if end_year > 0, delete files from start_year to end_year
-                result = "failed to delete " + pvname 
-                if start_year > end_year:
-                    print("Aborted: start={}>end={}".format(start_year,end_year))
-                    return
-                    
-                (pvs_info, zero_names) = _get_pvs_file_info([pvname], \
-                                                only_report_current_year=False)
-                pv_info = pvs_info[0]
-                years = pv_info[pvname+'(years)'].split()
-                if not years:
-                    print("%s: no .pb files"%pvname)
-                    try:
-                        result = archiver.pause_pv(pvname)
-                        result = archiver.delete_pv(pvname, delete_data=False)
-                    except:
-                        pass                
-                if not years:
-                    continue
-                        
-                oldest = int(min(years))     
-                newest = int(max(years))
-                if oldest > end_year or newest < start_year:
-                    print("{}: requested start-end-years out of range [{}, {}]."\
-                            .format(pvname, oldest, newest))
-                    continue
-                    
-                file_names = pv_info[pvname+'(file_names)'].split()
-                for i in range(len(years)):
-                    if start_year <= int(years[i]) <= end_year:
-                        subprocess.call(['sudo', 'rm', '-f', file_names[i]])
-                #if not os.path.isfile(file_names[0]): # .pb file has been deleted
-                result = archiver.pause_pv(pvname)
-                result = archiver.delete_pv(pvname, delete_data=False)
+        elif act == 'delete_pvs_and_data': # delete all data
+            result = archiver.delete_pv(pvname, delete_data=True)
                                                       
         results.append(result)
         try:
@@ -414,6 +557,7 @@ def _action(pvnames_src=None, act="unknown", **kargs):
             
     _log(results, act+" pv details")
     _log(valid_pvnames, act+" pvnames")
+    return valid_pvnames
     
     
 def abort_pvs(pvnames_src=None):
@@ -453,7 +597,9 @@ def delete_pvs_only(pvnames_src=None):
 
 def delete_pvs_and_data(pvnames_src=None, **kargs):
     '''Delete each pv and its archived data if permission is allowed.
-    Two keyword arguments could be used: start_year=0, end_year=2017.
+    Two keyword arguments could be used: start_year=0, end_year=2017. If end_year
+    is given, a summary of files per year is printed before confirmation; 
+    dry_run=True only prints that summary.
     pvnames_src(source where we get pvnames): 
     1) default is None: pvnames are currently paused PVs;
     2) a list of pv names: e.g. ['pv1', 'pv2'];
@@ -471,22 +617,209 @@ def change_pvs_archival_parameters(pvnames_src=None, **kargs):
     _action(pvnames_src=pvnames_src, act='change_pvs_archival_parameters', **kargs) 
     
         
-def get_reconnected_pvnames(do_return=False):
-    '''Report those paused pv names, which are reconnected / online again.'''
-    try:
-        from cothread.catools import connect
-    except:
-        print("Aborted: python-cothread is not installed")
+def tune_overflow_pvs(apply=False, do_return=False, **kargs):
+    '''Propose (and apply if apply=True) new archival parameters for PVs that 
+    are dropping events because of buffer overflow, see help(pyAA.tuner). 
+    The proposals are always printed first (dry-run) and logged. 
+    Supported keyword arguments: limit=1000, max_rate=1.0 (samples/s), factor=2.0, 
+    method='SCAN', batch_size=100, workers=8.'''
+    import tuner # pandas is only imported when it is needed
+    batch_size = kargs.pop('batch_size', 100)
+    proposals = tuner.propose(archiver, **kargs)
+    if not len(proposals):
+        print("No PVs are dropping events because of buffer overflow.")
         return
+    tuner.print_diff(proposals)
+    _log(proposals.to_dict('records'), "overflow tuner proposals")
+    
+    if apply:
+        _get_authentication()
+        answer = raw_input("Do you really wanna change archival parameters of \
+%d PVs? Type yes or no: "%len(proposals))
+        if answer.upper() != "YES":
+            print("Quit. Nothing done.")
+        else:
+            results = tuner.apply(archiver, proposals, batch_size=batch_size,
+                                  workers=kargs.get('workers', 8))
+            _log(results, "overflow tuner pv details")
+    if do_return:
+        return proposals
+
+        
+def export_pvs_data(pvnames_src, start, end, out_dir, **kargs):
+    '''Export archived data of pvs to partitioned Parquet or HDF5 files with
+    bounded memory. An interrupted export resumes where it stopped if it is 
+    called again with the same arguments. 
+    pvnames_src(source where we get pvnames): 
+    1) a list of pv names: e.g. ['pv1', 'pv2'];
+    2) filename: e.g. '/path/to/pvlist.txt', pvnames should be listed as one column.
+    start, end: e.g. '2018-07-04 13:00' or datetime objects; 
+    out_dir: e.g. '/path/to/export'. 
+    Supported keyword arguments: fmt='parquet' or 'hdf5', chunk=timedelta(days=1), 
+    workers=4, resume=True. See help(pyAA.export.export_data).'''
+    if isinstance(pvnames_src, list):
+        pvnames = pvnames_src
+    else:
+        pvnames = _get_pvnames_from_file(pvnames_src)
+    pvnames = _get_pvnames(pvnames)
+    if not pvnames:
+        return
+    
+    results = export.export_data(archiver, pvnames, start, end, out_dir, **kargs)
+    failed = [r for r in results if r['status'] != 'ok']
+    print("Exported {} PVs to {}: {} failed.".format(len(results), out_dir, 
+                                                      len(failed)))
+    _log(results, "export pv details")
+    if failed:
+        print("Call export_pvs_data() again with the same arguments to resume.")
+
+
+def _catalog_source(src):
+    '''(pv names generator, status function or None) of a catalog source'''
+    if src is None:
+        src = archiver
+    elif isinstance(src, list):
+        return (iter(src), None)
+    elif os.path.isfile(str(src)):
+        return (utils.iter_pvnames_from_file(src), None)
+    elif not isinstance(src, ArchiverAppliance): # hostname of another Archiver
+        src = ArchiverAppliance(hostname=str(src))
+    return (src.iter_all_pvs(), src.get_pvs_status)
+
+
+def diff_pvs(left_src=None, right_src=None, statuses=True, do_return=False, 
+             **kargs):
+    '''Compare two PV catalogs with bounded memory (streamed, externally sorted, 
+    merge-joined), e.g. during migrations. A catalog source can be:
+    1) None: all pvs of this Archiver;
+    2) a hostname or an ArchiverAppliance object: all pvs of another Archiver;
+    3) a list of pv names: e.g. ['pv1', 'pv2'];
+    4) filename: e.g. '/path/to/pvlist.txt', pvnames should be listed as one column.
+    PVs only in the left / right catalog are written to only_left.txt / 
+    only_right.txt in ~/aa-script-logs/diff-pvs-<timestamp>; if both sources 
+    are Archivers and statuses=True, PVs of both catalogs with different 
+    statuses are written to status_mismatch.tsv. 
+    Supported keyword arguments: out_dir, chunk_size=1000000 (max pv names 
+    sorted in memory), batch_size=500 (pvs per status request), presorted.
+    See help(pyAA.catalog.diff).'''
+    (left, left_status) = _catalog_source(left_src)
+    (right, right_status) = _catalog_source(right_src)
+    if not statuses:
+        left_status = right_status = None
+    out_dir = kargs.pop('out_dir', log_dir + "/diff-pvs" + 
+                        str(time.strftime("-%Y%b%d_%H%M%S")))
+    result = catalog.diff(left, right, out_dir, left_status, right_status, 
+                          **kargs)
+    print("left: {left} PVs, right: {right} PVs, both: {both}; only left: \
+{only_left}, only right: {only_right}, status mismatch: {status_mismatch}".format(
+          **result))
+    print("See the files in {}".format(out_dir))
+    if do_return:
+        return result
+
+
+def audit_pvs_data(pvnames_src, start, end, do_return=False, **kargs):
+    '''Scan archived data of pvs for gaps, disconnects (INVALID severity) and 
+    stuck values in one parallel pass, then print and log a summary table.
+    pvnames_src(source where we get pvnames): 
+    1) a list of pv names: e.g. ['pv1', 'pv2'];
+    2) filename: e.g. '/path/to/pvlist.txt', pvnames should be listed as one column.
+    start, end: e.g. '2018-07-04 13:00' or datetime objects. 
+    Supported keyword arguments: max_gap=3600 (seconds), stuck_time=86400 
+    (seconds), chunk=timedelta(days=1), workers=8. See help(pyAA.quality.scan).'''
+    import quality
+    if isinstance(pvnames_src, list):
+        pvnames = pvnames_src
+    else:
+        pvnames = _get_pvnames_from_file(pvnames_src)
+    pvnames = _get_pvnames(pvnames)
+    if not pvnames:
+        return
+    
+    summary = quality.scan(archiver, pvnames, start, end, **kargs)
+    print(summary.sort_values("downtime", ascending=False).head(20))
+    print("{} PVs: {:.0f} gaps, {:.0f} disconnects, {:.0f} stuck runs, {:.1f} \
+hours of downtime; {} PVs failed.".format(len(summary), summary["gaps"].sum(), 
+        summary["disconnects"].sum(), summary["stuck_runs"].sum(), 
+        summary["downtime"].sum() / 3600.0, (summary["error"] != "").sum()))
+    results = [odict([("pvName", pv)] + list(row.items())) 
+               for (pv, row) in summary.iterrows()]
+    _log(results, "data quality")
+    if do_return:
+        return summary
+
         
-    pvnames = []    
-    paused_pvnames =  report_paused_pvs(do_return=True)
-    results = connect(paused_pvnames, cainfo=True, throw=False)
-    for result in results:
-        if result.ok:
-            pvnames.append(result.name)
+health_store_dir = log_dir + "/health"
+
+def snapshot_health(interval=300, retention_days=7, count=None, **kargs):
+    '''Collect the never connected, currently disconnected, paused and overflow
+    reports every 'interval' seconds ('count' times, default is forever) into a 
+    compact store (~/aa-script-logs/health) which only keeps added/removed PVs 
+    between snapshots. Changes older than 'retention_days' are compacted. 
+    Use report_health_changes() to see what changed since a given time.'''
+    store = health.HealthStore(kargs.pop('store_dir', health_store_dir))
+    health.run(archiver, store, interval=interval, 
+               retention=retention_days*24*3600, count=count, **kargs)
+
+
+def report_health_changes(since, report_type=None, do_return=False, **kargs):
+    '''Report PVs added to / removed from the reports collected by 
+    snapshot_health() since 'since' (e.g. '2018-07-04 13:00' UTC, a datetime, 
+    or epoch seconds). report_type: one of 'never connected', 'currently 
+    disconnected', 'paused', 'overflow'; default is all of them.'''
+    store = health.HealthStore(kargs.pop('store_dir', health_store_dir))
+    changes = {}
+    for report_type in ([report_type] if report_type else health.REPORTS):
+        change = store.changes_since(report_type, since)
+        print("{} pvs since {}: {} added, {} removed".format(report_type, 
+            time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime(change["since"])), 
+            len(change["added"]), len(change["removed"])))
+        for pvname in change["added"][:10]:
+            print("  + " + pvname)
+        for pvname in change["removed"][:10]:
+            print("  - " + pvname)
+        changes[report_type] = change
+    if do_return:
+        return changes
+
+        
+_probers = {} # (backend, batch_size, timeout, ttl, workers) -> probe.Prober,
+              # to keep the probing cache across calls
+
+def get_reconnected_pvnames(do_return=False, resume=False, backend=None, 
+                            batch_size=1000, timeout=2.0, ttl=300, workers=4):
+    '''Report those paused pv names, which are reconnected / online again.
+    Paused PVs are probed in batches (batch_size=1000 channels at a time, 
+    timeout=2.0 seconds per batch); results are cached for ttl=300 seconds.
+    backend: 'cothread', 'pyepics' or 'fake' (default: cothread, then pyepics).
+    resume=True resumes the reconnected PVs in batches after confirmation.'''
+    import probe
+    key = (backend, batch_size, timeout, ttl, workers)
+    prober = _probers.get(key)
+    if prober is None:
+        try:
+            prober = probe.Prober(backend, batch_size=batch_size,
+                                  timeout=timeout, ttl=ttl, workers=workers)
+        except ImportError:
+            print("Aborted: neither python-cothread nor pyepics is installed")
+            return
+        _probers[key] = prober
+        
+    paused_pvnames = report_paused_pvs(do_return=True)
+    if not paused_pvnames:
+        return
+    pvnames = prober.connected(paused_pvnames, debug=True)
     
     _log(pvnames, 'reconnected pvnames')
+    if resume and pvnames:
+        answer = raw_input("Do you really wanna resume %d PVs? Type yes or no: "
+                           %len(pvnames))
+        if answer.upper() == "YES":
+            _get_authentication()
+            results = probe.resume_pvs(archiver, pvnames)
+            _log(results, "resume_pvs pv details")
+        else:
+            print("Nothing resumed.")
     if do_return:
         return pvnames
     
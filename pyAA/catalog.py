@@ -0,0 +1,194 @@
+# -*- coding: utf-8 -*-
+'''Streaming diff of PV catalogs with bounded memory.
+
+During migrations the catalog of an appliance (getAllPVs) is compared with the
+catalog of another appliance or with PV lists, each of them possibly holding
+tens of millions of names. Instead of loading both sides into sets:
+    1) each side is streamed (ArchiverAppliance.iter_all_pvs,
+       utils.iter_pvnames_from_file, or any iterable of names);
+    2) external_sort() sorts it in chunks of 'chunk_size' names written to
+       temporary files, which are then merged (heapq.merge); a side which is
+       already sorted is only checked;
+    3) merge_join() walks both sorted sides at the same time;
+    4) diff() writes only_left.txt, only_right.txt and, if status functions
+       are given, status_mismatch.tsv (the statuses of the names found on
+       both sides are fetched in batches).
+Memory use is bounded by chunk_size names plus one batch.
+'''
+
+from __future__ import print_function
+import os
+import io
+import heapq
+import shutil
+import tempfile
+import itertools
+
+ONLY_LEFT = "only_left.txt"
+ONLY_RIGHT = "only_right.txt"
+STATUS_MISMATCH = "status_mismatch.tsv"
+
+
+def _unique(names):
+    '''drop consecutive duplicates of sorted names'''
+    previous = None
+    for name in names:
+        if name != previous:
+            yield name
+            previous = name
+
+
+def _read_lines(path):
+    with io.open(path, 'r', encoding='utf-8') as fd:
+        for line in fd:
+            yield line.rstrip('\n')
+
+
+def _write_lines(path, lines):
+    with io.open(path, 'w', encoding='utf-8') as fd:
+        for line in lines:
+            fd.write(line + u'\n')
+
+
+def _text(name):
+    return name if isinstance(name, type(u'')) else name.decode('utf-8')
+
+
+def external_sort(names, chunk_size=1000000, tmp_dir=None):
+    '''Sort names (and drop duplicates) with at most chunk_size names in memory.
+
+    :param names: iterable of names (str), possibly bigger than the memory
+    :param tmp_dir: directory of the temporary sorted runs [default: system]
+    :return: generator of sorted unique names; temporary files are deleted
+             when it is exhausted or closed
+    '''
+    names = iter(names)
+    first = sorted(_text(n) for n in itertools.islice(names, chunk_size))
+    if len(first) < chunk_size: # fits in memory
+        for name in _unique(first):
+            yield name
+        return
+    run_dir = tempfile.mkdtemp(prefix="pyAA-sort-", dir=tmp_dir)
+    try:
+        runs = []
+        chunk = first
+        while chunk:
+            runs.append(os.path.join(run_dir, "run{}".format(len(runs))))
+            _write_lines(runs[-1], _unique(chunk))
+            chunk = sorted(_text(n) for n in itertools.islice(names, chunk_size))
+        for name in _unique(heapq.merge(*[_read_lines(r) for r in runs])):
+            yield name
+    finally:
+        shutil.rmtree(run_dir, ignore_errors=True)
+
+
+def checked_sorted(names):
+    '''names which are supposed to be sorted: duplicates are dropped and a
+    ValueError is raised at the first name out of order'''
+    previous = None
+    for name in names:
+        name = _text(name)
+        if previous is not None and name < previous:
+            raise ValueError("names are not sorted: {!r} after {!r}".format(
+                             name, previous))
+        if name != previous:
+            yield name
+        previous = name
+
+
+def merge_join(left, right):
+    '''Walk two sorted sequences of unique names.
+
+    :return: generator of (side, name) with side of 'left' (only in left),
+             'right' (only in right) or 'both'
+    '''
+    (left, right) = (iter(left), iter(right))
+    (l, r) = (next(left, None), next(right, None))
+    while l is not None and r is not None:
+        if l == r:
+            yield ("both", l)
+            (l, r) = (next(left, None), next(right, None))
+        elif l < r:
+            yield ("left", l)
+            l = next(left, None)
+        else:
+            yield ("right", r)
+            r = next(right, None)
+    while l is not None:
+        yield ("left", l)
+        l = next(left, None)
+    while r is not None:
+        yield ("right", r)
+        r = next(right, None)
+
+
+def diff(left, right, out_dir, left_status=None, right_status=None,
+         presorted=False, chunk_size=1000000, batch_size=500, tmp_dir=None):
+    '''Diff two catalogs with bounded memory.
+
+    :param left: iterable of pv names, e.g. archiver.iter_all_pvs()
+    :param right: iterable of pv names, e.g. utils.iter_pvnames_from_file(f)
+    :param out_dir: directory of the output files
+    :param left_status: function: list of pv names -> dict pv name -> status,
+                        e.g. archiver.get_pvs_status; with right_status, the
+                        statuses of pvs found on both sides are compared
+    :param presorted: True if both sides are already sorted (then they are
+                      only checked, not sorted again)
+    :param chunk_size: max number of names sorted in memory (per side)
+    :param batch_size: number of pvs per status lookup
+    :return: a dict with keys of left, right, both, only_left, only_right and
+             status_mismatch (counts), and files (output file names)
+    '''
+    if not os.path.isdir(out_dir):
+        os.makedirs(out_dir)
+    if presorted:
+        (left, right) = (checked_sorted(left), checked_sorted(right))
+    else:
+        (left, right) = (external_sort(left, chunk_size, tmp_dir),
+                         external_sort(right, chunk_size, tmp_dir))
+    counts = dict.fromkeys(["left", "right", "both", "only_left",
+                            "only_right", "status_mismatch"], 0)
+    statuses = left_status is not None and right_status is not None
+    names = (ONLY_LEFT, ONLY_RIGHT) + ((STATUS_MISMATCH,) if statuses else ())
+    files = dict((name, os.path.join(out_dir, name)) for name in names)
+    batch = []
+
+    def _compare(batch):
+        (lstatus, rstatus) = (left_status(batch), right_status(batch))
+        for name in batch:
+            (a, b) = (lstatus.get(name), rstatus.get(name))
+            if a != b:
+                mismatch.write(u"{}\t{}\t{}\n".format(name, a, b))
+                counts["status_mismatch"] += 1
+
+    only_left = io.open(files[ONLY_LEFT], 'w', encoding='utf-8')
+    only_right = io.open(files[ONLY_RIGHT], 'w', encoding='utf-8')
+    mismatch = io.open(files[STATUS_MISMATCH], 'w', encoding='utf-8') \
+               if statuses else None
+    try:
+        if statuses:
+            mismatch.write(u"pvName\tleft\tright\n")
+        for (side, name) in merge_join(left, right):
+            if side == "left":
+                only_left.write(name + u"\n")
+                counts["only_left"] += 1
+            elif side == "right":
+                only_right.write(name + u"\n")
+                counts["only_right"] += 1
+            else:
+                counts["both"] += 1
+                if statuses:
+                    batch.append(name)
+                    if len(batch) >= batch_size:
+                        _compare(batch)
+                        batch = []
+        if batch:
+            _compare(batch)
+    finally:
+        for fd in (only_left, only_right, mismatch):
+            if fd is not None:
+                fd.close()
+    counts["left"] = counts["both"] + counts["only_left"]
+    counts["right"] = counts["both"] + counts["only_right"]
+    counts["files"] = files
+    return counts
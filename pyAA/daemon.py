@@ -0,0 +1,277 @@
+# -*- coding: utf-8 -*-
+'''A long-lived pyAA service with warm caches and a local Unix socket API.
+
+Every "python -c 'from pyAA import aa; ...'" pays python startup, the pandas
+import, reading aa.conf and the Archiver handshake again. The daemon pays them
+once, then keeps the ArchiverAppliance session, the PV catalog, PV type info
+and the LTS file index warm and serves requests over a local Unix socket.
+
+Start the daemon (on the Archiver server):
+
+    $ python pyAA/daemon.py serve [--socket ~/.pyAA.sock]
+
+Then use the thin client, which only imports the standard library:
+
+    $ python pyAA/daemon.py report_paused_pvs
+    $ python pyAA/daemon.py search 'SR:C03-BI*'
+    $ python pyAA/daemon.py get_data 'SR:C03-BI{BPM:1}Pos:X-I' 2018-07-04 2018-07-05
+    $ python pyAA/daemon.py pause_pvs pv1 pv2
+    $ python pyAA/daemon.py delete_pvs_only pv1 pv2 confirm=true
+    $ python pyAA/daemon.py ops
+
+Protocol: the client sends one JSON line {"op": ..., "args": [...],
+"kwargs": {...}} and gets one JSON line back: {"ok": true, "result": ...}
+or {"ok": false, "error": "..."}. The socket is only accessible by its owner
+because actions (pause, delete, ...) are performed without an interactive
+prompt. Actions need pv names: the default pvs of an action (e.g. all paused
+pvs, see aa._action) are only used with all=true, and the actions deleting
+pvs are refused unless the request has confirm=true.
+'''
+
+from __future__ import print_function
+import os
+import re
+import sys
+import json
+import time
+import socket
+import fnmatch
+import threading
+try:
+    import socketserver #py3
+except ImportError:
+    import SocketServer as socketserver #py2
+
+SOCKET_PATH = os.path.expanduser('~/.pyAA.sock')
+
+REPORTS = ['report_never_connected_pvs', 'report_currently_disconnected_pvs',
+           'report_paused_pvs', 'report_pvs', 'report_all_pvs',
+           'report_pvs_from_file', 'report_waveform_pvs', 'report_storage_rate',
+           'report_storage_consumed', 'report_overflow_pvs']
+ACTIONS = ['abort_pvs', 'pause_pvs', 'resume_pvs', 'delete_pvs_only',
+           'delete_pvs_and_data', 'change_pvs_archival_parameters']
+# actions which are refused unless the request has confirm=true
+DESTRUCTIVE = ['delete_pvs_only', 'delete_pvs_and_data']
+
+
+class WarmState(object):
+    '''The aa module (ArchiverAppliance session, aa.conf) plus caches which
+    are refreshed after 'ttl' seconds (or by the 'refresh' op).'''
+
+    def __init__(self, ttl=600):
+        try:
+            from pyAA import aa
+        except ImportError:
+            import aa
+        self.aa = aa
+        self.archiver = aa.archiver
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self.refresh()
+
+    def refresh(self):
+        with self._lock:
+            self._catalog = (0, None)
+            self._lts_index = (0, None)
+            self._typeinfo = {}
+        return "caches dropped"
+
+    def _cached(self, name, build):
+        with self._lock:
+            (stamp, value) = getattr(self, name)
+        if value is None or time.time() - stamp > self.ttl:
+            value = build()
+            with self._lock:
+                setattr(self, name, (time.time(), value))
+        return value
+
+    def catalog(self):
+        '''all pv names in the Archiver'''
+        return self._cached('_catalog', lambda: sorted(
+                                       self.archiver.get_all_pvs(limit=-1)))
+
+    def lts_index(self):
+        '''index of the .pb files in the long-term storage'''
+        return self._cached('_lts_index', lambda: self.aa.store.scan_pb_files(
+                                           self.aa.aaconfig_dict["Lts"]["Path"]))
+
+    def typeinfo(self, pv):
+        with self._lock:
+            entry = self._typeinfo.get(pv)
+        if entry is None or time.time() - entry[0] > self.ttl:
+            entry = (time.time(), self.archiver.get_pv_type_info(pv))
+            with self._lock:
+                self._typeinfo[pv] = entry
+        return entry[1]
+
+
+class Handler(socketserver.StreamRequestHandler):
+    '''one JSON request per line, one JSON reply per line'''
+
+    def handle(self):
+        for line in self.rfile:
+            try:
+                request = json.loads(line.decode('utf-8'))
+                result = self.server.dispatch(request.get("op"),
+                        request.get("args", []), request.get("kwargs", {}))
+                reply = {"ok": True, "result": result}
+            except (Exception, SystemExit) as e: # aa may call sys.exit()
+                reply = {"ok": False, "error": "{}: {}".format(
+                                                      type(e).__name__, e)}
+            self.wfile.write((json.dumps(reply) + "\n").encode('utf-8'))
+            self.wfile.flush()
+
+
+class Daemon(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, path=SOCKET_PATH, ttl=600):
+        self.state = WarmState(ttl)
+        if os.path.exists(path):
+            os.remove(path)
+        socketserver.UnixStreamServer.__init__(self, path, Handler)
+        os.chmod(path, 0o600)
+        self.path = path
+        self.ops = {
+            "ops": lambda: sorted(self.ops),
+            "refresh": self.state.refresh,
+            "search": self.search,
+            "status": self.state.archiver.get_pv_status,
+            "typeinfo": self.state.typeinfo,
+            "file_info": self.file_info,
+            "get_data": self.get_data,
+        }
+        for name in REPORTS:
+            self.ops[name] = self._report(getattr(self.state.aa, name))
+        for name in ACTIONS:
+            self.ops[name] = self._act(name)
+
+    def dispatch(self, op, args, kwargs):
+        if op not in self.ops:
+            raise KeyError("unknown op {}; try 'ops'".format(op))
+        return self.ops[op](*args, **kwargs)
+
+    def _report(self, func):
+        def report(**kwargs):
+            kwargs['do_return'] = True
+            return func(**kwargs) or []
+        return report
+
+    def _act(self, act):
+        def action(*pvnames, **kwargs):
+            all_pvs = kwargs.pop('all', False) is True
+            confirmed = kwargs.pop('confirm', False) is True
+            if not pvnames and not all_pvs:
+                raise ValueError("no pv names given: add all=true to perform "
+                                 "{} on its default pvs".format(act))
+            if act in DESTRUCTIVE and not confirmed:
+                raise ValueError("{} deletes pvs: add confirm=true to the "
+                                 "request".format(act))
+            # without pv names (all=true), the default pvs of 'act'
+            pvnames_src = list(pvnames) if pvnames else None
+            # the daemon cannot prompt: the request is the confirmation, the
+            # destructive ones were explicitly confirmed above
+            return self.state.aa._action(pvnames_src=pvnames_src, act=act,
+                                         confirm=False, **kwargs) or []
+        return action
+
+    def search(self, pattern='*'):
+        '''GLOB search in the (cached) PV catalog'''
+        return fnmatch.filter(self.state.catalog(), pattern)
+
+    def file_info(self, *pvnames, **kwargs):
+        (info, zero_size) = self.state.aa._get_pvs_file_info(list(pvnames),
+                                  lts_index=self.state.lts_index(), **kwargs)
+        return info
+
+    def get_data(self, pv, start, end):
+        df = self.state.archiver.get_data(pv, start, end)
+        if not len(df):
+            return {"date": [], "val": []}
+        return {"date": [d.isoformat() for d in df.index],
+                "val": [v.tolist() if hasattr(v, 'tolist') else v
+                        for v in df["val"]]}
+
+
+def serve(path=SOCKET_PATH, ttl=600):
+    '''Run the pyAA daemon until interrupted'''
+    server = Daemon(path, ttl)
+    print("pyAA daemon listening on {}".format(path))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        os.remove(path)
+
+
+def call(op, *args, **kwargs):
+    '''Send one request to the pyAA daemon and return its result'''
+    path = kwargs.pop('socket_path', SOCKET_PATH)
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(path)
+        request = {"op": op, "args": list(args), "kwargs": kwargs}
+        sock.sendall((json.dumps(request) + "\n").encode('utf-8'))
+        reply = b""
+        while not reply.endswith(b"\n"):
+            data = sock.recv(65536)
+            if not data:
+                break
+            reply += data
+    finally:
+        sock.close()
+    reply = json.loads(reply.decode('utf-8'))
+    if not reply["ok"]:
+        raise RuntimeError(reply["error"])
+    return reply["result"]
+
+
+def _parse_cli(argv):
+    '''op arg1 arg2 key=value ... ; values are JSON if possible'''
+    args, kwargs = [], {}
+    for token in argv[1:]:
+        (key, sep, value) = token.partition('=')
+        if sep and re.match(r'^[A-Za-z_]\w*$', key): # not a pv name
+            kwargs[key] = _json_or_str(value)
+        else:
+            args.append(token)
+    return argv[0], args, kwargs
+
+
+def _json_or_str(value):
+    try:
+        return json.loads(value)
+    except ValueError:
+        return value
+
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    if not argv:
+        print(__doc__)
+        return 1
+    path = os.environ.get('PYAA_SOCKET', SOCKET_PATH)
+    if argv[0] == 'serve':
+        if len(argv) > 2 and argv[1] == '--socket':
+            path = argv[2]
+        serve(path)
+        return 0
+    (op, args, kwargs) = _parse_cli(argv)
+    try:
+        result = call(op, *args, socket_path=path, **kwargs)
+    except (socket.error, RuntimeError) as e:
+        print("Failed: {}".format(e), file=sys.stderr)
+        return 1
+    if isinstance(result, list) and all(not isinstance(r, (dict, list))
+                                        for r in result):
+        for item in result:
+            print(item)
+    else:
+        print(json.dumps(result, indent=2, sort_keys=True))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,360 @@
+# -*- coding: utf-8 -*-
+'''Decoding of the JSON responses of the Archiver Appliance.
+
+1) loads(): pluggable JSON decoder backend. The fastest installed backend is
+   used by default (orjson, simdjson, ujson, then the stdlib json); use
+   set_decoder('json') to change the default of the process, or
+   ArchiverAppliance(decoder='json') to choose one for that instance only.
+
+2) decode_data(): decode a data retrieval response ([{"meta":..., "data":[...]}])
+   into column arrays (secs, nanos, val, severity, status).
+
+3) DecodePool: decode_data() in a pool of processes. Decoding big payloads is
+   bound by the GIL; in worker processes it runs on all cores, and only the
+   column arrays (plain buffers) come back to the parent: the per-sample dicts
+   are never pickled.
+
+4) to_arrays(), to_structured(): the lightweight (pandas-free) results of
+   ArchiverAppliance.get_data(return_type="arrays" or "numpy").
+
+5) decode_stream(): incremental decoding of a data retrieval response read
+   chunk by chunk (requests' stream=True): samples are parsed one by one as
+   bytes arrive and appended to typed column buffers, so neither the whole
+   body nor the per-sample objects are ever held in memory. iter_array() yields
+   the items of a big JSON array (e.g. getAllPVs) one by one.
+
+Optional packages: numpy (array.array columns are used without numpy),
+orjson, pysimdjson, ujson.
+'''
+
+import json
+import array
+import codecs
+import multiprocessing
+from collections import OrderedDict as odict
+try:
+    import numpy as np
+except ImportError: # numpy is optional: array.array columns are used instead
+    np = None
+
+# integer columns of the samples and their array.array type codes
+FIELDS = (("secs", 'l'), ("nanos", 'l'), ("severity", 'i'), ("status", 'i'))
+
+
+def _orjson():
+    import orjson
+    return orjson.loads
+
+
+def _simdjson():
+    import simdjson
+    return simdjson.loads
+
+
+def _ujson():
+    import ujson
+    return ujson.loads
+
+
+def _json():
+    return json.loads
+
+
+# in order of preference
+BACKENDS = odict([("orjson", _orjson), ("simdjson", _simdjson),
+                  ("ujson", _ujson), ("json", _json)])
+
+_loads = None
+decoder = None # name of the current (default) backend
+_imported = {} # name -> loads function of the backends already imported
+
+
+def get_loads(name=None):
+    '''Find a JSON decoder backend (the current one is not changed).
+
+    :param name: one of BACKENDS ('orjson', 'simdjson', 'ujson', 'json');
+                 default is the fastest installed backend.
+    :return: (name, loads function) of the backend
+    '''
+    if name is not None and name not in BACKENDS:
+        raise ValueError("decoder should be one of {}".format(list(BACKENDS)))
+    for backend in ([name] if name else BACKENDS):
+        if backend not in _imported:
+            try:
+                _imported[backend] = BACKENDS[backend]()
+            except ImportError:
+                if name: # explicitly requested
+                    raise
+                continue
+        return (backend, _imported[backend])
+
+
+def set_decoder(name=None):
+    '''Select the JSON decoder backend used by default in this process.
+
+    :param name: see get_loads()
+    :return: name of the selected backend
+    '''
+    global _loads, decoder
+    (decoder, _loads) = get_loads(name)
+    return decoder
+
+
+def loads(raw, decoder=None):
+    '''decode JSON bytes (or text) with the backend 'decoder' (a name of
+    BACKENDS) [default: the current backend]'''
+    return (get_loads(decoder)[1] if decoder else _loads)(raw)
+
+
+set_decoder()
+
+
+def to_arrays(samples):
+    '''Column arrays (array.array) of samples: a dict with keys of secs, nanos,
+    val, severity and status. "val" is a list for strings and waveforms.'''
+    columns = {}
+    for (name, typecode) in FIELDS:
+        columns[name] = array.array(typecode, [s.get(name, 0) for s in samples])
+    values = [s["val"] for s in samples]
+    try:
+        columns["val"] = array.array('d', values)
+    except TypeError: # strings or waveforms
+        columns["val"] = values
+    return columns
+
+
+def numpy_to_arrays(columns):
+    '''Column arrays (array.array) from numpy column arrays'''
+    result = dict((name, array.array(typecode, columns[name].tolist()))
+                  for (name, typecode) in FIELDS)
+    val = columns["val"]
+    if val.dtype.kind == 'f' and val.ndim == 1:
+        result["val"] = array.array('d', val.tolist())
+    else: # strings or waveforms
+        result["val"] = val.tolist()
+    return result
+
+
+def to_numpy(samples):
+    '''Column arrays (numpy) of samples; "val" is 2-D for waveforms'''
+    columns = {}
+    for (name, dtype) in (("secs", np.int64), ("nanos", np.int64),
+                          ("severity", np.int32), ("status", np.int32)):
+        columns[name] = np.fromiter((s.get(name, 0) for s in samples),
+                                    dtype=dtype, count=len(samples))
+    values = [s["val"] for s in samples]
+    try:
+        columns["val"] = np.asarray(values, dtype=float)
+    except (TypeError, ValueError): # strings, or waveforms of varying length
+        columns["val"] = np.asarray(values, dtype=object)
+    return columns
+
+
+def to_structured(columns):
+    '''numpy structured array (secs, nanos, val, severity, status) from column
+    arrays'''
+    val = np.asarray(columns["val"])
+    dtype = [("secs", np.int64), ("nanos", np.int64),
+             ("val", val.dtype, val.shape[1:]),
+             ("severity", np.int32), ("status", np.int32)]
+    result = np.empty(len(val), dtype=dtype)
+    for name in ("secs", "nanos", "val", "severity", "status"):
+        result[name] = columns[name]
+    return result
+
+
+def decode_data(raw, decoder=None):
+    '''Decode a data retrieval response into column arrays.
+
+    :param raw: response body (bytes) of getData.json
+    :param decoder: name of the JSON decoder backend [default: current one]
+    :return: [{"meta": meta, "columns": {"secs", "nanos", "val", "severity",
+             "status"}}] (an empty list if the pv has no data); the columns are
+             numpy arrays ("val" is 2-D for waveforms), or array.array if
+             numpy is not installed.
+    '''
+    data = loads(raw, decoder)
+    if not data:
+        return []
+    samples = data[0]["data"]
+    columns = to_numpy(samples) if np is not None else to_arrays(samples)
+    return [{"meta": data[0].get("meta", {}), "columns": columns}]
+
+
+class ColumnBuffers(object):
+    '''Growing typed column buffers (array.array) of samples; "val" becomes a
+    list at the first string or waveform value.'''
+
+    def __init__(self):
+        self.columns = dict((name, array.array(typecode))
+                            for (name, typecode) in FIELDS)
+        self.columns["val"] = array.array('d')
+        self._appends = [(name, self.columns[name].append)
+                         for (name, typecode) in FIELDS]
+
+    def append(self, sample):
+        for (name, append) in self._appends:
+            append(sample.get(name, 0))
+        try:
+            self.columns["val"].append(sample["val"])
+        except TypeError: # strings or waveforms
+            if isinstance(self.columns["val"], list):
+                raise
+            self.columns["val"] = self.columns["val"].tolist()
+            self.columns["val"].append(sample["val"])
+
+    def result(self):
+        '''the columns as numpy arrays, or array.array without numpy'''
+        if np is None:
+            return self.columns
+        columns = {}
+        for (name, dtype) in (("secs", np.int64), ("nanos", np.int64),
+                              ("severity", np.int32), ("status", np.int32)):
+            columns[name] = _from_array(self.columns[name], dtype)
+        val = self.columns["val"]
+        if isinstance(val, array.array):
+            columns["val"] = _from_array(val, float)
+        else:
+            try:
+                columns["val"] = np.asarray(val, dtype=float)
+            except (TypeError, ValueError):
+                columns["val"] = np.asarray(val, dtype=object)
+        return columns
+
+
+def _from_array(buf, dtype):
+    '''numpy copy of an array.array'''
+    if not len(buf):
+        return np.empty(0, dtype=dtype)
+    return np.frombuffer(buf, dtype=buf.typecode).astype(dtype)
+
+
+_WHITESPACE = " \t\n\r"
+
+
+class _StreamTokens(object):
+    '''JSON text read chunk by chunk: complete values are decoded by the C
+    scanner of the json module; what has been parsed is dropped.'''
+
+    def __init__(self, chunks, encoding="utf-8"):
+        self.scan = json.JSONDecoder().raw_decode
+        self.text = codecs.getincrementaldecoder(encoding)()
+        self.chunks = iter(chunks)
+        (self.buf, self.pos, self.eof) = ("", 0, False)
+
+    def more(self):
+        '''read the next chunk; False at the end of the stream'''
+        if self.eof:
+            return False
+        chunk = next(self.chunks, None)
+        if chunk is None:
+            self.eof = True
+            chunk = b""
+        if self.pos > 65536: # drop what has been parsed
+            (self.buf, self.pos) = (self.buf[self.pos:], 0)
+        self.buf += self.text.decode(chunk, final=self.eof)
+        return True
+
+    def skip(self, chars=_WHITESPACE):
+        '''skip chars; return the next char ('' at the end of the stream)'''
+        while True:
+            (buf, pos) = (self.buf, self.pos)
+            while pos < len(buf) and buf[pos] in chars:
+                pos += 1
+            self.pos = pos
+            if pos < len(buf):
+                return buf[pos]
+            if not self.more():
+                return ""
+
+    def expect(self, char):
+        if self.skip() != char:
+            raise ValueError("expected {!r} at offset {} of the response"
+                             .format(char, self.pos))
+        self.pos += 1
+
+    def value(self):
+        '''decode the next complete JSON value'''
+        self.skip()
+        while True:
+            try:
+                (value, end) = self.scan(self.buf, self.pos)
+            except ValueError: # incomplete: read more
+                if not self.more():
+                    raise
+                continue
+            if end == len(self.buf) and not self.eof and \
+                    isinstance(value, (int, float)):
+                self.more() # a number may continue in the next chunk
+                continue
+            self.pos = end
+            return value
+
+    def items(self):
+        '''values of the array starting at the current position'''
+        self.expect("[")
+        while self.skip(_WHITESPACE + ",") not in ("]", ""):
+            yield self.value()
+        self.expect("]")
+
+
+def decode_stream(chunks, encoding="utf-8"):
+    '''Decode a data retrieval response incrementally.
+
+    The envelope [{"meta": {...}, "data": [{sample}, ...]}] is parsed as
+    chunks arrive: each complete sample is decoded (by the C scanner of the
+    json module) and appended to the column buffers, then dropped. Only the
+    first pv of the response is decoded, as in decode_data().
+
+    :param chunks: iterable of bytes, e.g. requests' r.iter_content(65536)
+    :return: same as decode_data()
+    '''
+    tokens = _StreamTokens(chunks, encoding)
+    if tokens.skip() == "":
+        return []
+    tokens.expect("[")
+    if tokens.skip() == "]":
+        return []
+    tokens.expect("{")
+    (meta, buffers) = ({}, ColumnBuffers())
+    while tokens.skip(_WHITESPACE + ",") not in ("}", ""):
+        key = tokens.value()
+        tokens.expect(":")
+        if key != "data":
+            value = tokens.value()
+            if key == "meta":
+                meta = value
+            continue
+        for sample in tokens.items():
+            buffers.append(sample)
+    return [{"meta": meta, "columns": buffers.result()}]
+
+
+def iter_array(chunks, encoding="utf-8"):
+    '''Items of a JSON array (e.g. the pv names of getAllPVs) decoded one by
+    one as chunks arrive.
+
+    :param chunks: iterable of bytes, e.g. requests' r.iter_content(65536)
+    :return: generator of the items
+    '''
+    tokens = _StreamTokens(chunks, encoding)
+    if tokens.skip() == "":
+        return
+    for item in tokens.items():
+        yield item
+
+
+class DecodePool(object):
+    '''Decode big data retrieval payloads in a pool of worker processes.'''
+
+    def __init__(self, processes=None):
+        self.pool = multiprocessing.Pool(processes)
+
+    def decode_data(self, raw, decoder=None):
+        '''same as decode_data(), but in a worker process; the calling thread
+        only waits (without holding the GIL) for the column arrays.'''
+        return self.pool.apply(decode_data, (raw, decoder))
+
+    def close(self):
+        self.pool.close()
+        self.pool.join()
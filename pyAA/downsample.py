@@ -0,0 +1,188 @@
+# -*- coding: utf-8 -*-
+'''Client-side visual downsampling of archived data for plotting.
+
+Even with server-side binning, plots of millions of samples need a
+shape-preserving reduction down to a pixel budget:
+    - minmax(): min/max envelope, two points (min and max) per bucket;
+    - lttb(): Largest-Triangle-Three-Buckets, which keeps the points with
+      the largest visual contribution;
+    - downsample(): either of them on a `pandas.DataFrame` (as returned by
+      ArchiverAppliance.get_data) or on (x, y) arrays;
+    - downsample_stream(): min/max envelope (optionally followed by LTTB) of
+      chunks streamed from ArchiverAppliance.iter_data, without keeping the
+      full-resolution data in memory.
+All of them run in linear time with vectorized numpy operations.
+
+Packages required: numpy (and pandas for DataFrames).
+'''
+
+import numpy as np
+
+METHODS = ("lttb", "minmax")
+
+
+def _as_xy(data, y=None):
+    '''(x, y) float arrays from a DataFrame (date index, "val" column) or arrays;
+    datetimes are converted to epoch seconds'''
+    if y is None: # a DataFrame
+        x, y = data.index.values, data["val"].values
+    else:
+        x = data
+    x = np.asarray(x)
+    if np.issubdtype(x.dtype, np.datetime64):
+        x = x.astype("datetime64[ns]").astype(np.int64) * 1e-9
+    return x.astype(float), np.asarray(y, dtype=float)
+
+
+def minmax_indices(y, n_out):
+    '''indices of the min and max of y in n_out/2 buckets of equal size, in
+    increasing order (the first and last points are always kept)'''
+    n = len(y)
+    if n <= n_out or n_out < 4:
+        return np.arange(n)
+    n_buckets = (n_out - 2) // 2
+    size = -(-(n - 2) // n_buckets) # ceil
+    padded = np.full(n_buckets * size, np.nan)
+    padded[:n - 2] = y[1:n - 1]
+    padded = padded.reshape(n_buckets, size)
+    valid = ~np.all(np.isnan(padded), axis=1)
+    filled_min = np.where(np.isnan(padded), np.inf, padded)
+    filled_max = np.where(np.isnan(padded), -np.inf, padded)
+    offsets = np.arange(n_buckets)[valid] * size + 1
+    indices = np.concatenate([[0], offsets + filled_min.argmin(axis=1)[valid],
+                              offsets + filled_max.argmax(axis=1)[valid], [n - 1]])
+    return np.unique(indices)
+
+
+def lttb_indices(x, y, n_out):
+    '''indices of the points selected by Largest-Triangle-Three-Buckets'''
+    n = len(y)
+    if n <= n_out or n_out < 3:
+        return np.arange(n)
+    # bucket boundaries of the n-2 inner points
+    edges = (np.arange(n_out - 1) * (n - 2) / float(n_out - 2)).astype(int) + 1
+    edges[-1] = n - 1
+    selected = np.empty(n_out, dtype=np.int64)
+    selected[0], selected[-1] = 0, n - 1
+    a = 0
+    for i in range(n_out - 2):
+        lo, hi = edges[i], edges[i + 1]
+        # the third point: average of the next bucket (the last point at the end)
+        if i < n_out - 3:
+            nlo, nhi = edges[i + 1], edges[i + 2]
+            cx, cy = x[nlo:nhi].mean(), y[nlo:nhi].mean()
+        else:
+            cx, cy = x[n - 1], y[n - 1]
+        # twice the area of the triangles (a, j, c) for all j of the bucket
+        area = np.abs((x[a] - cx) * (y[lo:hi] - y[a]) -
+                      (x[a] - x[lo:hi]) * (cy - y[a]))
+        a = lo + int(np.nanargmax(area)) if hi > lo else lo
+        selected[i + 1] = a
+    return selected
+
+
+def minmax(x, y, n_out):
+    '''min/max envelope of (x, y) with about n_out points'''
+    x, y = _as_xy(x, y)
+    indices = minmax_indices(y, n_out)
+    return x[indices], y[indices]
+
+
+def lttb(x, y, n_out):
+    '''Largest-Triangle-Three-Buckets downsampling of (x, y) to n_out points'''
+    x, y = _as_xy(x, y)
+    indices = lttb_indices(x, y, n_out)
+    return x[indices], y[indices]
+
+
+def downsample(data, n_out=1000, method="lttb"):
+    '''Downsample a `pandas.DataFrame` as returned by get_data (date index,
+    "val" column) to about n_out rows.
+
+    :param method: 'lttb' or 'minmax'
+    :return: a `pandas.DataFrame` with the selected rows
+    '''
+    if method not in METHODS:
+        raise ValueError("method should be one of {}".format(METHODS))
+    (x, y) = _as_xy(data)
+    if method == "lttb":
+        indices = lttb_indices(x, y, n_out)
+    else:
+        indices = minmax_indices(y, n_out)
+    return data.iloc[indices]
+
+
+class StreamingMinMax(object):
+    '''min/max envelope of data streamed chunk by chunk, with n_out/2 buckets of
+    equal duration between start and end (epoch seconds)'''
+
+    def __init__(self, start, end, n_out=1000):
+        self.start = float(start)
+        self.n_buckets = max(1, n_out // 2)
+        self.width = (float(end) - self.start) / self.n_buckets
+        self.min_x = np.full(self.n_buckets, np.nan)
+        self.min_y = np.full(self.n_buckets, np.inf)
+        self.max_x = np.full(self.n_buckets, np.nan)
+        self.max_y = np.full(self.n_buckets, -np.inf)
+
+    def _extreme_per_bucket(self, buckets, x, y, sign):
+        '''(bucket, x, y) of the min (sign=1) or max (sign=-1) of each bucket'''
+        order = np.lexsort((sign * y, buckets))
+        (first, index) = np.unique(buckets[order], return_index=True)
+        return first, x[order][index], y[order][index]
+
+    def update(self, x, y=None):
+        '''x, y: a chunk (DataFrame or arrays) in any time order'''
+        (x, y) = _as_xy(x, y)
+        ok = ~np.isnan(y) & (x >= self.start)
+        x, y = x[ok], y[ok]
+        buckets = ((x - self.start) / self.width).astype(np.int64)
+        keep = buckets < self.n_buckets
+        buckets, x, y = buckets[keep], x[keep], y[keep]
+        if not len(y):
+            return
+        (b, bx, by) = self._extreme_per_bucket(buckets, x, y, 1)
+        better = by < self.min_y[b]
+        self.min_x[b[better]], self.min_y[b[better]] = bx[better], by[better]
+        (b, bx, by) = self._extreme_per_bucket(buckets, x, y, -1)
+        better = by > self.max_y[b]
+        self.max_x[b[better]], self.max_y[b[better]] = bx[better], by[better]
+
+    def result(self):
+        '''(x, y) of the envelope in time order'''
+        x = np.concatenate([self.min_x, self.max_x])
+        y = np.concatenate([self.min_y, self.max_y])
+        ok = ~np.isnan(x)
+        x, y = x[ok], y[ok]
+        (x, index) = np.unique(x, return_index=True) # min == max: one point
+        return x, y[index]
+
+
+def downsample_stream(chunks, start, end, n_out=1000, method="lttb"):
+    '''Downsample data streamed chunk by chunk, e.g.
+    downsample_stream(archiver.iter_data(pv, start, end), start, end, 2000)
+
+    The min/max envelope (2*n_out points for 'lttb', n_out for 'minmax') is
+    updated chunk by chunk; with 'lttb' it is then reduced to n_out points.
+
+    :param chunks: iterable of DataFrames, or of (t0, t1, DataFrame) tuples
+    :param start: start time. Can be a string or `datetime.datetime` object.
+    :param end: end time. Can be a string or `datetime.datetime` object.
+    :return: a `pandas.DataFrame` indexed by date with a "val" column
+    '''
+    import pandas as pd
+    if method not in METHODS:
+        raise ValueError("method should be one of {}".format(METHODS))
+    (t0, t1) = [pd.Timestamp(t).value * 1e-9 for t in (start, end)]
+    envelope = StreamingMinMax(t0, t1, 2 * n_out if method == "lttb" else n_out)
+    for chunk in chunks:
+        if isinstance(chunk, tuple):
+            chunk = chunk[-1]
+        if len(chunk):
+            envelope.update(chunk)
+    (x, y) = envelope.result()
+    if method == "lttb":
+        indices = lttb_indices(x, y, n_out)
+        x, y = x[indices], y[indices]
+    index = pd.to_datetime(np.round(x * 1e9).astype(np.int64), unit="ns")
+    return pd.DataFrame({"val": y}, index=pd.Index(index, name="date"))
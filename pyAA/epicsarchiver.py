@@ -10,18 +10,23 @@ Documentation on all methods in the class ArchiverAppliance:
 http://slacmshankar.github.io/epicsarchiver_docs/api/org/epics/archiverappliance/
 mgmt/bpl/package-summary.html
 
-Packages required: python-requests, python-pandas, 
+Packages required: python-requests, python-pandas (only imported when a 
+pandas.DataFrame is returned), 
 """
 
 import sys
+import copy
+import time
+import threading
+from collections import OrderedDict as odict
 try:
     import urllib.parse as urlparse #py3
 except ImportError:
     import urlparse #py2
 import requests
-import pandas as pd
-from datetime import datetime
+from datetime import datetime, timedelta
 import utils
+import decode
 
 # the following three libraries can be used to solve
 ## "HTTPError: 403 Client Error" on Debian 7 / Python 2.7.3 / requests 0.12.1  
@@ -32,6 +37,43 @@ import json
 import socket
 localhost = socket.getfqdn() # it seems full hostname is required for AA
 
+pd = None # pandas is only imported when a DataFrame is requested: see _pandas()
+
+def _pandas():
+    global pd
+    if pd is None:
+        import pandas
+        pd = pandas
+    return pd
+
+RETURN_TYPES = ("frame", "numpy", "arrays")
+MAX_PAGED_PVS = 1024 # max number of pvs whose last window is kept (prefetch)
+
+
+def _private_copy(result):
+    """Copy of a shared result for one caller: DataFrames and numpy arrays
+    are copied by their copy() method, other results (lists of dicts, dicts of
+    array.array columns) by copy.deepcopy()"""
+    if hasattr(result, "copy") and not isinstance(result, (dict, list)):
+        return result.copy()
+    return copy.deepcopy(result)
+
+
+class _Flight(object):
+    """An in-flight request whose result is shared by all its callers"""
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = None
+        self.error = None
+
+    def wait(self):
+        self.event.wait()
+        if self.error is not None:
+            raise self.error
+        return self.result
+
+
 class ArchiverAppliance:
     """EPICS Arcvhier Appliance (AA) client
 
@@ -39,6 +81,29 @@ class ArchiverAppliance:
 
     :param hostname: EPICS Archiver Appliance hostname [default: localhost]
     :param port: EPICS Archiver Appliance management port [default: 17665]
+    :param decoder: JSON decoder backend of this instance: 'orjson',
+                    'simdjson', 'ujson' or 'json' [default: the default of
+                    decode.py, i.e. the fastest installed one]
+    :param decode_processes: if > 0, data retrieval payloads bigger than
+                    decode_threshold bytes are decoded into arrays by a pool
+                    of that many processes [default: 0, i.e. no pool]
+    :param decode_threshold: see decode_processes [default: 4 MB]
+    :param prefetch: if True, when get_data() is called for consecutive time
+                    windows of a PV (paging), the next adjacent window is
+                    retrieved in the background [default: False]
+    :param prefetch_size: max number of prefetched windows kept [default: 8]
+    :param stream: if True, data retrieval responses are read with
+                    stream=True and decoded incrementally into column arrays
+                    while they arrive (see decode.decode_stream), which lowers
+                    peak memory of big windows; the decode pool is then not
+                    used [default: False]
+
+    Call close() (or use the instance as a context manager) to shut down the
+    decode pool processes and the HTTP session.
+
+    Identical get_data() and get_pv_status() calls made concurrently (e.g. by
+    the threads of a web backend) are coalesced: only one HTTP request is sent
+    and the callers waiting for it get their own copy of the decoded result.
 
     Basic Usage::
 
@@ -49,9 +114,13 @@ class ArchiverAppliance:
         >>> archappl.get_pv_status(pv='BPM*')
         >>> _end = datetime.utcnow()
         >>> df = archappl.get_data('my:pv', start='2018-07-04 13:00', end=_end)
+        >>> with ArchiverAppliance('archiver-01', decode_processes=4) as aa:
+        ...     df = aa.get_data('my:pv', start='2018-07-04 13:00', end=_end)
     """
 
-    def __init__(self, hostname=localhost, port=17665):
+    def __init__(self, hostname=localhost, port=17665, decoder=None,
+                 decode_processes=0, decode_threshold=4*1024*1024,
+                 prefetch=False, prefetch_size=8, stream=False):
         self.hostname = hostname
         #self.mgmt_url = f"http://{hostname}:{port}/mgmt/bpl/"  # py3
         self.mgmt_url = "http://{}:{}/mgmt/bpl/".format(hostname, port) #py2
@@ -59,10 +128,102 @@ class ArchiverAppliance:
         self._data_url = None
         self.session = requests.Session()
         #self.session.auth = ('user', 'pass')
+        if decoder is not None:
+            decode.get_loads(decoder) # ImportError if it is not installed
+        self.decoder = decoder # None: the current default of decode.py
+        self.decode_pool = None
+        if decode_processes > 0:
+            self.decode_pool = decode.DecodePool(decode_processes)
+        self.decode_threshold = decode_threshold
+        self.stream = stream
+        self._lock = threading.Lock()
+        self._inflight = {} # request key -> _Flight
+        self.prefetch = prefetch
+        self.prefetch_size = prefetch_size
+        self._prefetched = odict() # request key -> _Flight, oldest first
+        # pv -> (start, end) of its last get_data(), least recently used first
+        self._last_window = odict()
+
+    def close(self):
+        """Shut down the decode pool (if any) and close the HTTP session"""
+        pool, self.decode_pool = self.decode_pool, None
+        if pool is not None:
+            pool.close()
+        self.session.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
  
+    def _single_flight(self, key, func, *args):
+        """Call func(*args), unless an identical call (same key) is already in
+        flight: then wait for it and get a copy of its result (or its
+        exception), so that callers cannot modify each other's result"""
+        with self._lock:
+            flight = self._inflight.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._inflight[key] = _Flight()
+        if not leader:
+            return _private_copy(flight.wait())
+        try:
+            flight.result = func(*args)
+        except Exception as e:
+            flight.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._inflight[key]
+            flight.event.set()
+        return flight.result
+
+    def _prefetch(self, pv, start, end, return_type):
+        """Retrieve the window [start, end] of pv in a background thread"""
+        key = ("data", pv, utils.format_date(start), utils.format_date(end),
+               return_type)
+        flight = _Flight()
+        with self._lock:
+            if key in self._prefetched or key in self._inflight:
+                return
+            self._prefetched[key] = flight
+            while len(self._prefetched) > self.prefetch_size:
+                self._prefetched.popitem(last=False)
+
+        def _run():
+            try:
+                flight.result = self._single_flight(key, self._fetch_data,
+                                                    pv, start, end, return_type)
+            except Exception as e:
+                flight.error = e
+            finally:
+                flight.event.set()
+        thread = threading.Thread(target=_run)
+        thread.daemon = True
+        thread.start()
+
+    def _maybe_prefetch(self, pv, start, end, return_type="frame"):
+        """Prefetch the next adjacent window if pv is paged through"""
+        start, end = utils.to_datetime(start), utils.to_datetime(end)
+        with self._lock:
+            last = self._last_window.pop(pv, None)
+            self._last_window[pv] = (start, end)
+            while len(self._last_window) > MAX_PAGED_PVS:
+                self._last_window.popitem(last=False)
+        if last is None or end <= start:
+            return
+        if last[1] == start: # paging forward
+            self._prefetch(pv, end, end + (end - start), return_type)
+        elif last[0] == end: # paging backward
+            self._prefetch(pv, start - (end - start), start, return_type)
+
     def _return_json(self, r):
         try:
-            return r.json() # for > python-2.7.3
+            # pluggable backend, see decode.py
+            return decode.loads(r.content, self.decoder)
+        except ValueError:
+            raise
         except:
             return r.json   # for Debian 7.11: python-2.7.3, requests-0.12.1
 
@@ -125,6 +286,11 @@ class ArchiverAppliance:
             self._data_url = self.info.get("dataRetrievalURL") + "/data/getData.json"
         return self._data_url
 
+    @property
+    def data_at_time_url(self):
+        """EPICS Archiver Appliance bulk point-in-time retrieval url"""
+        return self.data_url.replace("/data/getData.json", "/data/getDataAtTime")
+
     def get_all_expanded_pvs(self):
         """Return all expanded PV names in the cluster. 
         (yhu-2020-Dec-22: it seems this method does not work)
@@ -165,6 +331,25 @@ class ArchiverAppliance:
         r = self.get("/getAllPVs", params=params)
         return self._return_json(r)
 
+    def iter_all_pvs(self, pv=None, regex=None, limit=-1):
+        """Same as get_all_pvs(), but the response is streamed: PV names are
+        decoded one by one while they arrive, so a catalog of millions of PVs
+        is never held in memory (default: all PVs)
+
+        :return: generator of PV names
+        """
+        params = {"limit": limit}
+        if pv is not None:
+            params["pv"] = pv
+        if regex is not None:
+            params["regex"] = regex
+        r = self.get("/getAllPVs", params=params, stream=True)
+        try:
+            for pvname in decode.iter_array(r.iter_content(64 * 1024)):
+                yield pvname
+        finally:
+            r.close()
+
     def get_pv_status(self, pv):
         """Return the status of a PV
 
@@ -172,8 +357,10 @@ class ArchiverAppliance:
                    Can be a GLOB wildcards or multiple PVs as a comma separated list.
         :return: list of dict with the status of the matching PVs
         """
-        r = self.get("/getPVStatus", params={"pv": pv})
-        return self._return_json(r)
+        def _get_status(pv):
+            r = self.get("/getPVStatus", params={"pv": pv})
+            return self._return_json(r)
+        return self._single_flight(("status", pv), _get_status, pv)
 
     def get_pv_status_from_files(self, files, appliance=None):
         """Return the status of PVs from a list of files
@@ -241,15 +428,95 @@ class ArchiverAppliance:
         r = self.post("/archivePV", json=pvs)
         return self._return_json(r)
 
-    def archive_pvs_from_files(self, files, appliance=None):
-        """Archive PVs from a list of files
+    def archive_pvs_from_files(self, files, appliance=None, **kwargs):
+        r"""Archive PVs from a list of files
+
+        The files are parsed lazily and the PVs go through the submission
+        pipeline of archive_pvs_in_batches.
 
         :param files: list of files in CSV format with PVs to archive.
         :param appliance: optional appliance to use to archive PVs (in a cluster)
-        :return: list of submitted PVs
+        :param \*\*kwargs: optional batch_size, workers, retries of
+                           archive_pvs_in_batches
+        :return: a list of dicts (one per PV) with keys of pvName and status
         """
-        pvs = utils.get_pvs_from_files(files, appliance)
-        return self.archive_pvs(pvs)
+        pvs = utils.iter_pvs_from_files(files, appliance)
+        return self.archive_pvs_in_batches(pvs, **kwargs)
+
+    def archive_pvs_in_batches(self, pvs, batch_size=500, workers=4, retries=3,
+                               debug=False):
+        """Archive PVs with a streaming submission pipeline
+
+        PVs are consumed lazily, duplicates are dropped, the status of each
+        batch is fetched in bulk and only PVs which are not being archived (nor
+        pending) are submitted. Batches are submitted concurrently, each
+        submission being retried with an exponential backoff.
+
+        :param pvs: iterable of PVs (as dict, see utils.parse_archive_file)
+        :param batch_size: number of PVs per request
+        :param workers: number of concurrent submissions
+        :param retries: number of retries of a failed submission
+        :param bool debug: print the throughput after each batch
+        :return: a list of dicts (one per PV) with keys of pvName and status
+        """
+        def _submit(batch):
+            for attempt in range(retries + 1):
+                try:
+                    return self.archive_pvs(batch)
+                except Exception as e:
+                    if attempt == retries:
+                        return [{"pvName": pv["pv"], "status": "failed",
+                                 "validation": str(e)} for pv in batch]
+                    time.sleep(2 ** attempt)
+
+        results, seen, pending = [], set(), []
+        counts = {"duplicated": 0, "skipped": 0, "submitted": 0}
+        started = time.time()
+
+        def _collect(pending, limit):
+            # bounded number of batches in flight: wait for the oldest ones
+            while len(pending) > limit:
+                results.extend(pending.pop(0).get(utils.WAIT_FOREVER))
+
+        def _process(batch):
+            statuses = self.get_pvs_status([pv["pv"] for pv in batch])
+            todo = []
+            for pv in batch:
+                status = statuses.get(pv["pv"], "Not being archived")
+                if status == "Not being archived":
+                    todo.append(pv)
+                else: # already archived, or pending
+                    results.append({"pvName": pv["pv"], "status": status})
+                    counts["skipped"] += 1
+            if todo:
+                counts["submitted"] += len(todo)
+                pending.append(pool.apply_async(_submit, (todo,)))
+                _collect(pending, 2 * workers)
+            if debug:
+                print("{} PVs submitted, {} skipped, {:.1f} PVs/s".format(
+                      counts["submitted"], counts["skipped"],
+                      (counts["submitted"] + counts["skipped"]) /
+                      max(time.time() - started, 1e-6)))
+
+        with utils.worker_pool(max(1, workers)) as pool:
+            batch = []
+            for pv in pvs:
+                if pv["pv"] in seen:
+                    counts["duplicated"] += 1
+                    continue
+                seen.add(pv["pv"])
+                batch.append(pv)
+                if len(batch) == batch_size:
+                    _process(batch)
+                    batch = []
+            if batch:
+                _process(batch)
+            _collect(pending, 0)
+        elapsed = max(time.time() - started, 1e-6)
+        print("{} PVs submitted, {} already archived or pending, {} duplicates "
+              "dropped in {:.1f}s ({:.1f} PVs/s)".format(counts["submitted"],
+              counts["skipped"], counts["duplicated"], elapsed, len(seen) / elapsed))
+        return results
 
     def _get_or_post(self, endpoint, pv):
         """Send a GET or POST if pv is a comma separated list
@@ -372,14 +639,99 @@ class ArchiverAppliance:
             "samplingmethod": sampling_method})
             return self.request_by_urllib2(url)
 
-    def get_data(self, pv, start, end):
+    def get_data(self, pv, start, end, return_type="frame"):
         """Retrieve archived data
 
         :param pv: name of the pv.
         :param start: start time. Can be a string or `datetime.datetime` object.
         :param end: end time. Can be a string or `datetime.datetime` object.
+        :param return_type: "frame" (default): `pandas.DataFrame` indexed by date;
+            "numpy": numpy structured array with fields of secs, nanos, val,
+            severity and status (same as "arrays" if numpy is not installed);
+            "arrays": dict of `array.array` columns (secs, nanos, val,
+            severity, status). "numpy" and "arrays" never import pandas, which
+            saves latency and memory for short queries.
+        :return: see return_type
+        """
+        if return_type not in RETURN_TYPES:
+            raise ValueError("return_type should be one of {}".format(RETURN_TYPES))
+        key = ("data", pv, utils.format_date(start), utils.format_date(end),
+               return_type)
+        with self._lock:
+            flight = self._prefetched.pop(key, None)
+        df = None
+        if flight is not None:
+            try:
+                df = flight.wait()
+            except Exception:
+                pass # the prefetch failed: retrieve it again below
+        if df is None:
+            df = self._single_flight(key, self._fetch_data, pv, start, end,
+                                     return_type)
+        if self.prefetch:
+            self._maybe_prefetch(pv, start, end, return_type)
+        return df
+
+    def _fetch_data(self, pv, start, end, return_type="frame"):
+        data = self._get_raw_data(pv, start, end)
+        if return_type == "frame":
+            return self._data_to_frame(data)
+        return self._data_to_arrays(data, return_type)
+
+    def _data_to_arrays(self, data, return_type):
+        """Convert decoded JSON data into array.array or numpy columns"""
+        if return_type == "numpy" and decode.np is not None:
+            if data and "columns" in data[0]: # decoded by DecodePool
+                return decode.to_structured(data[0]["columns"])
+            return decode.to_structured(decode.to_numpy(
+                                        data[0]["data"] if data else []))
+        if data and "columns" in data[0]: # decoded by DecodePool
+            columns = data[0]["columns"]
+            if decode.np is None:
+                return columns
+            return decode.numpy_to_arrays(columns)
+        return decode.to_arrays(data[0]["data"] if data else [])
+
+    def iter_data(self, pv, start, end, chunk=timedelta(days=1)):
+        """Retrieve archived data chunk by chunk
+
+        The time range is split into consecutive windows of length 'chunk' and
+        each window is retrieved only when the previous one has been consumed,
+        so memory usage is bounded by the size of a single window.
+
+        :param pv: name of the pv.
+        :param start: start time. Can be a string or `datetime.datetime` object.
+        :param end: end time. Can be a string or `datetime.datetime` object.
+        :param chunk: window length as `datetime.timedelta` (or seconds)
+        :return: generator of (window_start, window_end, `pandas.DataFrame`)
+        """
+        end = utils.to_datetime(end)
+        for (t0, t1) in utils.time_windows(start, end, chunk):
+            yield (t0, t1, self.get_window_data(pv, t0, t1, closed=(t1 >= end)))
+
+    def get_window_data(self, pv, start, end, closed=False):
+        """Retrieve archived data strictly inside the window [start, end)
+
+        AA also returns the last sample before 'start'; it is dropped here so
+        that consecutive windows can be appended without duplicated samples.
+
+        :param pv: name of the pv.
+        :param start: start time. Can be a string or `datetime.datetime` object.
+        :param end: end time. Can be a string or `datetime.datetime` object.
+        :param closed: if True, the window is [start, end] (the last window)
         :return: `pandas.DataFrame`
         """
+        start, end = utils.to_datetime(start), utils.to_datetime(end)
+        df = self.get_data(pv, start, end)
+        if len(df):
+            if closed:
+                df = df[df.index >= start]
+            else:
+                df = df[(df.index >= start) & (df.index < end)]
+        return df
+
+    def _get_raw_data(self, pv, start, end):
+        """Retrieve archived data as decoded JSON ([{"meta":..., "data":[...]}])"""
         # http://slacmshankar.github.io/epicsarchiver_docs/userguide.html
         params = {
             "pv": pv,
@@ -387,7 +739,15 @@ class ArchiverAppliance:
             "to": utils.format_date(end),
         }
         try:
+            if self.stream:
+                r = self.get(self.data_url, params=params, stream=True)
+                try:
+                    return decode.decode_stream(r.iter_content(64 * 1024))
+                finally:
+                    r.close()
             r = self.get(self.data_url, params=params)
+            if self.decode_pool and len(r.content) >= self.decode_threshold:
+                return self.decode_pool.decode_data(r.content, self.decoder)
             data = self._return_json(r)
         except:
             url = self.data_url + "?pv=" + urllib.quote_plus(pv) + '&' + \
@@ -396,6 +756,21 @@ urllib.urlencode({"from":utils.format_date(start), "to":utils.format_date(end)})
             req = urllib2.urlopen(url)
             data = json.load(req)
             #data = self.request_by_urllib2(url)
+        return data
+
+    def _data_to_frame(self, data):
+        """Convert decoded JSON data into a `pandas.DataFrame` indexed by date"""
+        pd = _pandas()
+        if not data: # no data at all for the requested time range
+            return pd.DataFrame()
+        if "columns" in data[0]: # already decoded into arrays by DecodePool
+            columns = data[0]["columns"]
+            val = columns["val"]
+            df = pd.DataFrame({"val": list(val) if val.ndim > 1 else val},
+                index=pd.to_datetime(columns["secs"] + columns["nanos"] * 1e-9,
+                                     unit="s"))
+            df.index.name = "date"
+            return df
         df = pd.DataFrame(data[0]["data"])
         #print(df)
         try:
@@ -412,6 +787,62 @@ urllib.urlencode({"from":utils.format_date(start), "to":utils.format_date(end)})
             df = df.set_index("date")
         return df
 
+    def get_snapshot(self, pvs, at, chunk_size=1000, workers=4):
+        """Retrieve the value of many PVs at a point in time (machine state at T)
+
+        Uses the bulk getDataAtTime retrieval endpoint: the pv list is POSTed
+        in chunks of 'chunk_size' names and the chunks are sent concurrently.
+
+        :param pvs: a list of pv names
+        :param at: point in time. Can be a string or `datetime.datetime` object.
+        :param chunk_size: number of pvs per request
+        :param workers: number of concurrent requests
+        :return: `pandas.DataFrame` indexed by pv with columns of val, severity,
+                 status and date (NaN for pvs without data at that time)
+        """
+        pd = _pandas()
+        params = {"at": utils.format_date(at), "includeProxies": "false"}
+        chunks = [pvs[i:i + chunk_size] for i in range(0, len(pvs), chunk_size)]
+
+        def _post(chunk):
+            r = self.request("POST", self.data_at_time_url, params=params,
+                             json=chunk)
+            return self._return_json(r)
+
+        results = utils.map_concurrently(_post, chunks, workers)
+        samples = {}
+        for result in results:
+            samples.update(result)
+        df = pd.DataFrame.from_dict(samples, orient="index")
+        df = df.reindex(index=pvs,
+                        columns=["val", "severity", "status", "secs", "nanos"])
+        df["date"] = pd.to_datetime(df["secs"] + df["nanos"] * 1e-9, unit="s")
+        df.index.name = "pv"
+        return df[["val", "severity", "status", "date"]]
+
+    def stats(self, pv, start, end, percentiles=(50, 95, 99), **kwargs):
+        r"""Compute statistics of archived data without materializing the data
+
+        Data are consumed chunk by chunk by mergeable online accumulators
+        (see pyAA.onlinestats), in parallel across PVs and time slices.
+
+        :param pv: name of the pv, or a list of pv names.
+        :param start: start time. Can be a string or `datetime.datetime` object.
+        :param end: end time. Can be a string or `datetime.datetime` object.
+        :param percentiles: percentiles to estimate. Default to (50, 95, 99).
+        :param \*\*kwargs: optional extra keyword arguments
+            - chunk: retrieval window length (`datetime.timedelta` or seconds)
+            - slices: number of time slices per pv
+            - workers: number of concurrent retrieval jobs
+            - delta: t-digest compression (accuracy vs. memory)
+        :return: `pandas.DataFrame` indexed by pv with columns of count, min,
+                 max, mean, std, p50, ..., time_weighted_mean
+        """
+        import onlinestats # numpy and pandas are only needed here
+        pvs = list(pv) if isinstance(pv, (list, tuple)) else [pv]
+        return onlinestats.compute_stats(self, pvs, start, end,
+                                         percentiles=percentiles, **kwargs)
+
     def pause_rename_resume_pv(self, pv, new, debug=False):
         """Pause, rename and resume a PV
 
@@ -432,7 +863,7 @@ urllib.urlencode({"from":utils.format_date(start), "to":utils.format_date(end)})
         if not utils.check_result(result, "Error while pausing {}".format(pv)):
             return
         result = self.rename_pv(pv, new)
-        if not utils.check_result(result,"Error: renaming {} to {}").format(pv,new):
+        if not utils.check_result(result, "Error: renaming {} to {}".format(pv, new)):
             return
         result = self.resume_pv(new)
         if not utils.check_result(result, "Error while resuming {}".format(new)):
@@ -440,18 +871,109 @@ urllib.urlencode({"from":utils.format_date(start), "to":utils.format_date(end)})
         if debug:
             print("PV {} successfully renamed to {}".format(pv, new))
 
-    def rename_pvs_from_files(self, files, debug=False):
-        """Rename PVs from a list of files
+    def rename_pvs_from_files(self, files, debug=False, **kwargs):
+        r"""Rename PVs from a list of files
 
-        Each PV will be paused, renamed and resumed
+        Each PV will be paused, renamed and resumed (see rename_pvs)
 
         :param files: list of files in CSV format with PVs to rename.
-        :return: None
+        :param \*\*kwargs: optional batch_size and workers of rename_pvs
+        :return: a list of dicts (one per PV) with keys of pvName, newName,
+                 outcome and message
         """
         pvs = utils.get_rename_pvs_from_files(files)
-        for (current, new) in pvs:
-            self.pause_rename_resume_pv(current, new, debug)
-    
+        return self.rename_pvs(pvs, debug=debug, **kwargs)
+
+    def get_pvs_status(self, pvs, batch_size=500):
+        """Return the status of many PVs with one request per batch
+
+        :param pvs: a list of pv names (no GLOB wildcards)
+        :param batch_size: number of pvs per request
+        :return: a dict: pv name -> status (e.g. "Being archived")
+        """
+        statuses = {}
+        for i in range(0, len(pvs), batch_size):
+            result = self._get_or_post("/getPVStatus",
+                                       ",".join(pvs[i:i + batch_size]))
+            for (pv, status) in utils.results_by_pv(result).items():
+                statuses[pv] = status.get("status")
+        return statuses
+
+    def rename_pvs(self, pvs, batch_size=100, workers=8, debug=False):
+        """Rename many PVs with a pipeline of bulk requests
+
+        1) the (current, new) pairs are validated up front: duplicated
+           current or new names, and chains or cycles of renames (a new name
+           which is the current name of another pair) are rejected;
+        2) the status of all current and new names is fetched in bulk;
+        3) PVs are paused in batches, renamed concurrently ('workers' threads)
+           and the new names are resumed in batches. A PV which could not be
+           renamed is resumed under its current name.
+
+        :param pvs: a list of (current, new) pv names
+        :param batch_size: number of pvs per pause/resume request
+        :param workers: number of concurrent rename requests
+        :param bool debug: enable debug logging
+        :return: a list of dicts (one per pair) with keys of pvName, newName,
+                 outcome ("renamed", "skipped" or "failed") and message
+        """
+        (pairs, report) = utils.validate_renames(pvs)
+        statuses = self.get_pvs_status(
+                    [old for (old, new) in pairs] + [new for (old, new) in pairs])
+        todo = []
+        for (old, new) in pairs:
+            if statuses.get(old) != "Being archived":
+                report.append(utils.outcome(old, new, "skipped",
+                                            "PV isn't being archived"))
+            elif statuses.get(new, "Not being archived") != "Not being archived":
+                report.append(utils.outcome(old, new, "skipped",
+                                            "New PV already exists"))
+            else:
+                todo.append((old, new))
+
+        def _batches(names):
+            return [names[i:i + batch_size]
+                    for i in range(0, len(names), batch_size)]
+
+        paused = []
+        for batch in _batches(todo):
+            result = utils.results_by_pv(self.pause_pv(
+                                         ",".join(old for (old, new) in batch)))
+            for (old, new) in batch:
+                if result.get(old, {}).get("status", "ok") == "ok":
+                    paused.append((old, new))
+                else:
+                    report.append(utils.outcome(old, new, "failed",
+                                                "Error while pausing"))
+
+        def _rename(pair):
+            try:
+                result = self.rename_pv(*pair)
+            except Exception as e:
+                result = {"status": "nok", "validation": str(e)}
+            return (pair, result)
+
+        renamed = utils.map_concurrently(_rename, paused, workers)
+
+        to_resume = []
+        for ((old, new), result) in renamed:
+            if result.get("status", "nok").lower() == "ok":
+                to_resume.append((new, utils.outcome(old, new, "renamed", "")))
+            else:
+                to_resume.append((old, utils.outcome(old, new, "failed",
+                            result.get("validation", "Error while renaming"))))
+        for batch in _batches(to_resume):
+            result = utils.results_by_pv(self.resume_pv(
+                                         ",".join(pv for (pv, o) in batch)))
+            for (pv, outcome) in batch:
+                if result.get(pv, {}).get("status", "ok") != "ok":
+                    outcome["message"] += " Error while resuming {}".format(pv)
+                report.append(outcome)
+                if debug and outcome["outcome"] == "renamed":
+                    print("PV {} successfully renamed to {}".format(
+                          outcome["pvName"], outcome["newName"]))
+        return report
+
     def get_pv_type_info(self, pv):
         """Get the type info for a given PV. In the AA terminology, 
         the PVTypeInfo contains the various archiving parameters for a PV.
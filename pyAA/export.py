@@ -0,0 +1,180 @@
+# -*- coding: utf-8 -*-
+'''Out-of-core export of archived data to partitioned Parquet or HDF5 files.
+
+Data are retrieved window by window (see ArchiverAppliance.get_window_data) and each
+window is written straight to disk, so memory usage is bounded by one window
+per worker no matter how long the requested time range is. PVs are exported
+in parallel by a pool of worker threads.
+
+Layout of the output directory:
+    out_dir/manifest.json               export parameters
+    out_dir/checkpoint.jsonl            one line per finished (pv, window)
+    out_dir/<quoted-pv>/<window>.parquet   fmt='parquet': one file per window
+    out_dir/<quoted-pv>/<window>.h5        fmt='hdf5': one file per window (key
+                                           'data'); HDF5 writes are serialized
+                                           because PyTables is not thread safe
+
+An interrupted export is resumed by calling export_data() again with the same
+arguments: windows already listed in checkpoint.jsonl are skipped.
+'''
+
+from __future__ import print_function
+import os
+import json
+import threading
+from datetime import timedelta
+try:
+    from urllib.parse import quote #py3
+except ImportError:
+    from urllib import quote #py2
+import utils
+
+MANIFEST = "manifest.json"
+CHECKPOINT = "checkpoint.jsonl"
+FORMATS = ("parquet", "hdf5")
+EXTENSIONS = {"parquet": ".parquet", "hdf5": ".h5"}
+
+_hdf5_lock = threading.Lock() # one HDF5 write at a time in the process
+
+
+def _window_key(t0):
+    '''partition key of the window starting at t0, e.g. 20180704T130000'''
+    return t0.strftime("%Y%m%dT%H%M%S")
+
+
+def pv_dirname(pvname):
+    '''file-system-safe (and reversible) name of a pv: SR:C03-BI{BPM:1} ->
+    SR%3AC03-BI%7BBPM%3A1%7D'''
+    return quote(pvname, safe='')
+
+
+class ExportCheckpoint(object):
+    '''Append-only record of the (pv, window) partitions which have been
+    written. A partially written last line (interrupted export) is ignored.'''
+
+    def __init__(self, out_dir):
+        self.path = os.path.join(out_dir, CHECKPOINT)
+        self._lock = threading.Lock()
+        self.done = {}
+        if os.path.isfile(self.path):
+            with open(self.path, 'r') as fd:
+                for line in fd:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        continue
+                    self.done[(entry["pv"], entry["window"])] = entry["rows"]
+
+    def is_done(self, pvname, key):
+        return (pvname, key) in self.done
+
+    def rows(self, pvname):
+        return sum(n for ((pv, key), n) in self.done.items() if pv == pvname)
+
+    def mark_done(self, pvname, key, rows):
+        line = json.dumps({"pv": pvname, "window": key, "rows": rows})
+        with self._lock:
+            self.done[(pvname, key)] = rows
+            with open(self.path, 'a') as fd:
+                fd.write(line + "\n")
+                fd.flush()
+                os.fsync(fd.fileno())
+
+
+def _check_manifest(out_dir, params, resume):
+    '''write the export parameters, or make sure a resumed export uses the
+    same parameters as the interrupted one'''
+    path = os.path.join(out_dir, MANIFEST)
+    if os.path.isfile(path) and resume:
+        with open(path, 'r') as fd:
+            previous = json.load(fd)
+        if previous != params:
+            raise ValueError("{} was written with different export parameters: "
+                "{}. Use another out_dir or resume=False.".format(path, previous))
+        return
+    if not resume: # start over
+        for name in (MANIFEST, CHECKPOINT):
+            if os.path.isfile(os.path.join(out_dir, name)):
+                os.remove(os.path.join(out_dir, name))
+    tmp = path + ".tmp"
+    with open(tmp, 'w') as fd:
+        json.dump(params, fd, indent=2, sort_keys=True)
+    os.rename(tmp, path)
+
+
+def _write_window(df, out_dir, pvname, key, fmt):
+    '''write one retrieval window to its own file, written as a temporary
+    file then renamed: a partition file only becomes visible once it is
+    complete, and an interrupted write never touches the finished windows'''
+    df = df.reset_index()
+    pv_dir = os.path.join(out_dir, pv_dirname(pvname))
+    if not os.path.isdir(pv_dir):
+        try:
+            os.makedirs(pv_dir)
+        except OSError: # created meanwhile by another worker
+            if not os.path.isdir(pv_dir):
+                raise
+    path = os.path.join(pv_dir, key + EXTENSIONS[fmt])
+    if fmt == "parquet":
+        df.to_parquet(path + ".tmp", index=False)
+    else:
+        with _hdf5_lock:
+            df.to_hdf(path + ".tmp", key="data", mode='w')
+    os.rename(path + ".tmp", path)
+
+
+def _export_pv(archiver, pvname, start, end, out_dir, fmt, chunk, checkpoint):
+    '''export all windows of a pv which are not in the checkpoint yet'''
+    summary = {"pvName": pvname, "status": "ok", "windows": 0, "skipped": 0}
+    try:
+        for (t0, t1) in utils.time_windows(start, end, chunk):
+            key = _window_key(t0)
+            if checkpoint.is_done(pvname, key):
+                summary["skipped"] += 1
+                continue
+            # retrieve one window at a time: memory is bounded by the window
+            df = archiver.get_window_data(pvname, t0, t1, closed=(t1 >= end))
+            if len(df):
+                _write_window(df, out_dir, pvname, key, fmt)
+            checkpoint.mark_done(pvname, key, len(df))
+            summary["windows"] += 1
+    except Exception as e:
+        summary["status"] = "failed: {}".format(e)
+    summary["rows"] = checkpoint.rows(pvname)
+    return summary
+
+
+def export_data(archiver, pvnames, start, end, out_dir, fmt="parquet",
+                chunk=timedelta(days=1), workers=4, resume=True):
+    '''Export archived data of 'pvnames' in [start, end) to 'out_dir'.
+
+    :param archiver: `ArchiverAppliance` object
+    :param pvnames: a list of pv names
+    :param start: start time. Can be a string or `datetime.datetime` object.
+    :param end: end time. Can be a string or `datetime.datetime` object.
+    :param out_dir: output directory, created if it does not exist
+    :param fmt: 'parquet' (needs pyarrow) or 'hdf5' (needs pytables)
+    :param chunk: retrieval window length as `datetime.timedelta` (or seconds);
+                  also the partition size of the output files
+    :param workers: number of pvs exported in parallel
+    :param resume: if True, skip the windows already exported to 'out_dir'
+    :return: a list of dicts (one per pv) with keys of pvName, status, rows, etc.
+    '''
+    if fmt not in FORMATS:
+        raise ValueError("fmt should be one of {}".format(FORMATS))
+    if not isinstance(chunk, timedelta):
+        chunk = timedelta(seconds=chunk)
+    start, end = utils.to_datetime(start), utils.to_datetime(end)
+    if not os.path.isdir(out_dir):
+        os.makedirs(out_dir)
+    params = {"start": utils.format_date(start), "end": utils.format_date(end),
+              "fmt": fmt, "chunk_seconds": chunk.total_seconds()}
+    _check_manifest(out_dir, params, resume)
+    checkpoint = ExportCheckpoint(out_dir)
+
+    def _worker(pvname):
+        return _export_pv(archiver, pvname, start, end, out_dir, fmt, chunk,
+                          checkpoint)
+
+    # interrupted: queued pvs are dropped, the checkpoint resumes the export
+    return utils.map_concurrently(_worker, pvnames, workers)
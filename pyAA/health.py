@@ -0,0 +1,173 @@
+# -*- coding: utf-8 -*-
+'''Scheduled health snapshots of the Archiver with incremental diffing.
+
+The reports of never connected, currently disconnected, paused and overflow
+PVs are collected periodically into a compact local store instead of new
+timestamped text files: for each report only the set deltas between two
+consecutive snapshots (added and removed PVs) are appended. "What changed
+since T" is answered from the deltas. Deltas older than the retention period
+are folded into a base snapshot (compaction), so disk use stays bounded.
+
+Layout of the store directory (one pair of files per report):
+    <report>.base.json      {"t": epoch seconds, "pvs": [...]}
+    <report>.deltas.jsonl   {"t": ..., "added": [...], "removed": [...]} per line
+'''
+
+from __future__ import print_function
+import os
+import json
+import time
+import calendar
+import datetime
+from collections import OrderedDict as odict
+import utils
+
+# report name -> ArchiverAppliance method
+REPORTS = odict([("never connected", "get_never_connected_pvs"),
+                 ("currently disconnected", "get_currently_disconnected_pvs"),
+                 ("paused", "get_paused_pvs_report"),
+                 ("overflow", "get_overflow_report")])
+
+
+def _epoch(t):
+    '''epoch seconds from epoch seconds, a datetime or a string (UTC)'''
+    if isinstance(t, (int, float)):
+        return float(t)
+    return float(calendar.timegm(utils.to_datetime(t).utctimetuple()))
+
+
+def _write_atomically(path, lines):
+    with open(path + ".tmp", 'w') as fd:
+        for line in lines:
+            fd.write(line + "\n")
+    os.rename(path + ".tmp", path)
+
+
+class HealthStore(object):
+    '''Base snapshot + append-only deltas of each report.'''
+
+    def __init__(self, path):
+        self.path = path
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        self._current = {} # report -> set of pv names, after the last delta
+
+    def _file(self, report, suffix):
+        return os.path.join(self.path, report.replace(" ", "-") + suffix)
+
+    def _load(self, report):
+        '''return (base_t, base_pvs, deltas)'''
+        (base_t, base_pvs, deltas) = (0.0, set(), [])
+        if os.path.isfile(self._file(report, ".base.json")):
+            with open(self._file(report, ".base.json"), 'r') as fd:
+                base = json.load(fd)
+            (base_t, base_pvs) = (base["t"], set(base["pvs"]))
+        if os.path.isfile(self._file(report, ".deltas.jsonl")):
+            with open(self._file(report, ".deltas.jsonl"), 'r') as fd:
+                for line in fd:
+                    try:
+                        delta = json.loads(line)
+                    except ValueError: # interrupted write
+                        continue
+                    if delta["t"] > base_t: # else: already compacted
+                        deltas.append(delta)
+        return (base_t, base_pvs, deltas)
+
+    def current(self, report):
+        '''pv names of the latest snapshot of 'report' '''
+        if report not in self._current:
+            (base_t, pvs, deltas) = self._load(report)
+            for delta in deltas:
+                pvs = (pvs - set(delta["removed"])) | set(delta["added"])
+            self._current[report] = pvs
+        return self._current[report]
+
+    def record(self, report, pvnames, t=None):
+        '''Append the delta between the latest snapshot and 'pvnames'.
+
+        :return: (added, removed) sorted lists of pv names
+        '''
+        t = time.time() if t is None else t
+        previous, pvnames = self.current(report), set(pvnames)
+        added = sorted(pvnames - previous)
+        removed = sorted(previous - pvnames)
+        if added or removed:
+            line = json.dumps({"t": t, "added": added, "removed": removed})
+            with open(self._file(report, ".deltas.jsonl"), 'a') as fd:
+                fd.write(line + "\n")
+        self._current[report] = pvnames
+        return (added, removed)
+
+    def changes_since(self, report, since):
+        '''What changed in 'report' since time 'since' (epoch seconds, datetime
+        or string in UTC).
+
+        :return: a dict with keys of added, removed (net changes, sorted) and
+                 since (the effective start time: the compacted base snapshot
+                 time if 'since' is older than the retention period)
+        '''
+        since = _epoch(since)
+        (base_t, pvs, deltas) = self._load(report)
+        for delta in deltas:
+            if delta["t"] > since:
+                break
+            pvs = (pvs - set(delta["removed"])) | set(delta["added"])
+        now = self.current(report)
+        return {"since": max(since, base_t), "added": sorted(now - pvs),
+                "removed": sorted(pvs - now)}
+
+    def compact(self, report, retention):
+        '''Fold the deltas older than 'retention' seconds into the base.'''
+        horizon = time.time() - retention
+        (base_t, pvs, deltas) = self._load(report)
+        old = [d for d in deltas if d["t"] <= horizon]
+        if not old:
+            return
+        for delta in old:
+            pvs = (pvs - set(delta["removed"])) | set(delta["added"])
+        # the new base is written first: deltas which are not newer than the
+        # base are ignored by _load() even if the next step is interrupted
+        _write_atomically(self._file(report, ".base.json"),
+                          [json.dumps({"t": old[-1]["t"], "pvs": sorted(pvs)})])
+        _write_atomically(self._file(report, ".deltas.jsonl"),
+                          [json.dumps(d) for d in deltas[len(old):]])
+
+
+def _pvnames(results):
+    return [r['pvName'] if isinstance(r, dict) else r for r in results or []]
+
+
+def collect(archiver, store, reports=None):
+    '''Take one snapshot of 'reports' (default: all REPORTS).
+
+    :return: a dict: report -> (added, removed)
+    '''
+    changes = odict()
+    for report in (reports or REPORTS):
+        results = getattr(archiver, REPORTS[report])()
+        changes[report] = store.record(report, _pvnames(results))
+    return changes
+
+
+def run(archiver, store, interval=300, retention=7*24*3600, count=None,
+        reports=None):
+    '''Collect snapshots every 'interval' seconds, 'count' times (default: until
+    interrupted) and keep 'retention' seconds of deltas.'''
+    n = 0
+    while count is None or n < count:
+        started = time.time()
+        try:
+            changes = collect(archiver, store, reports)
+        except Exception as e: # the Archiver may be restarting: try again
+            print("{}: failed to collect reports: {}".format(
+                                        datetime.datetime.now(), e))
+        else:
+            for (report, (added, removed)) in changes.items():
+                if added or removed:
+                    print("{}: {} pvs: +{} -{}".format(datetime.datetime.now(),
+                                            report, len(added), len(removed)))
+            for report in changes:
+                store.compact(report, retention)
+        n += 1
+        if count is None or n < count:
+            time.sleep(max(0, interval - (time.time() - started)))
@@ -0,0 +1,403 @@
+# -*- coding: utf-8 -*-
+'''Load generator: how many concurrent retrieval and BPL calls an appliance
+handles before latency degrades.
+
+Worker threads (each with its own ArchiverAppliance client, so that identical
+calls are not coalesced) run a weighted mix of operations for each stage of a
+ramp profile, e.g. 1, 2, 4, ... 64 concurrent clients for 30 seconds each:
+    - data: get_data() of a random pv over a random 'window' in [start, end];
+    - status: get_pv_status() of a random pv;
+    - bulk: get_pvs_status() of 'bulk_size' random pvs (batched POSTs);
+    - report: one of REPORTS (paused, disconnected, event rate ...).
+Each stage reports the throughput and the p50/p95/p99 latencies, overall and
+per operation.
+
+The load can target a real appliance or a local stand-in server
+(StandInServer) which serves synthetic data and BPL responses (bulk POSTs
+are answered per pv), e.g. to measure the client side alone:
+
+    $ python pyAA/loadtest.py --stand-in --ramp 1,4,16 --duration 10
+    $ python pyAA/loadtest.py --host archiver-01 --pvs pvlist.txt \
+          --mix data=8,status=1,report=1 --ramp 1,2,4,8,16,32 --duration 30
+
+Only the standard library and python-dateutil are used (plus python-requests
+by the client).
+'''
+
+from __future__ import print_function
+import sys
+import json
+import math
+import time
+import random
+import argparse
+import threading
+from collections import OrderedDict as odict
+from datetime import datetime, timedelta
+import utils
+try:
+    from http.server import HTTPServer, BaseHTTPRequestHandler #py3
+    import socketserver
+    from urllib.parse import urlparse, parse_qs
+except ImportError:
+    from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler #py2
+    import SocketServer as socketserver
+    from urlparse import urlparse, parse_qs
+
+OPERATIONS = ("data", "status", "bulk", "report")
+REPORTS = ("get_paused_pvs_report", "get_currently_disconnected_pvs",
+           "get_never_connected_pvs", "get_event_rate_report",
+           "get_storage_rate_report", "get_overflow_report")
+PERCENTILES = (50, 95, 99)
+
+
+def _archiver_appliance(hostname, port):
+    # not through the pyAA package: its __init__ imports aa.py (aa.conf and
+    # the Archiver handshake), which exits if no appliance is reachable
+    from epicsarchiver import ArchiverAppliance
+    return ArchiverAppliance(hostname, port)
+
+
+class _StandInHandler(BaseHTTPRequestHandler):
+    '''Synthetic responses for the endpoints used by the load generator'''
+
+    def log_message(self, *args):
+        pass # no line per request
+
+    def _reply(self, result):
+        body = json.dumps(result).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        params = dict((k, v[0]) for (k, v) in parse_qs(url.query).items())
+        pvnames = params["pv"].split(',') if params.get("pv") else []
+        self._answer(url.path.rsplit('/', 1)[-1], params, pvnames)
+
+    def do_POST(self):
+        url = urlparse(self.path)
+        params = dict((k, v[0]) for (k, v) in parse_qs(url.query).items())
+        length = int(self.headers.get('Content-Length') or 0)
+        body = self.rfile.read(length).decode('utf-8') if length else ""
+        self._answer(url.path.rsplit('/', 1)[-1], params, _posted_pvs(body))
+
+    def _answer(self, endpoint, params, pvnames):
+        server = self.server
+        if server.latency:
+            time.sleep(server.latency)
+        if endpoint == 'getApplianceInfo':
+            self._reply({"identity": "stand-in", "version": "stand-in",
+                "dataRetrievalURL": "http://{}:{}/retrieval".format(
+                                    server.server_address[0], server.port)})
+        elif endpoint == 'getData.json':
+            self._reply(server.data(params.get("pv", ""),
+                                    params.get("from"), params.get("to")))
+        elif endpoint == 'getDataAtTime':
+            self._reply(dict((pv, server.sample(params.get("at")))
+                             for pv in pvnames))
+        elif endpoint == 'getPVStatus':
+            self._reply([{"pvName": pv, "status": "Being archived" if pv in
+                          server.catalog else "Not being archived"}
+                         for pv in pvnames])
+        elif endpoint == 'archivePV':
+            self._reply([{"pvName": pv, "status": "Archive request submitted"}
+                         for pv in pvnames])
+        elif endpoint == 'unarchivedPVs':
+            self._reply([pv for pv in pvnames if pv not in server.catalog])
+        elif endpoint.startswith('get'): # reports
+            self._reply([{"pvName": pv, "eventRate": "1.0"}
+                         for pv in server.pvnames[:100]])
+        elif pvnames: # other BPL actions (pause, resume, ...) on each pv
+            self._reply([{"pvName": pv, "status": "ok"} for pv in pvnames])
+        else:
+            self.send_error(404)
+
+
+def _seconds(text):
+    '''epoch seconds of an ISO 8601 time of the requests'''
+    return (datetime.strptime(text[:19], "%Y-%m-%dT%H:%M:%S") -
+            datetime(1970, 1, 1)).total_seconds()
+
+
+def _posted_pvs(body):
+    '''pv names of a POST body: a JSON list of names or of {"pv": name}
+    (archivePV), a form "pv=a,b" or a comma separated list'''
+    body = body.strip()
+    if body.startswith('['):
+        return [item["pv"] if isinstance(item, dict) else item
+                for item in json.loads(body)]
+    if body.startswith('pv='):
+        body = parse_qs(body).get("pv", [""])[0]
+    return [pv for pv in body.split(',') if pv]
+
+
+class StandInServer(socketserver.ThreadingMixIn, HTTPServer):
+    '''A local HTTP server which mimics the appliance endpoints used by the load
+    generator, with 'rate' synthetic samples per second of data and an optional
+    fixed 'latency' (seconds) per request. Use port=0 for any free port.'''
+
+    daemon_threads = True
+
+    def __init__(self, port=0, rate=1.0 / 60, latency=0.0, npvs=1000):
+        HTTPServer.__init__(self, ('127.0.0.1', port), _StandInHandler)
+        self.port = self.server_address[1]
+        self.rate = rate
+        self.latency = latency
+        self.pvnames = ["STANDIN:PV{}".format(i) for i in range(npvs)]
+        self.catalog = set(self.pvnames)
+        self._thread = None
+
+    def _sample(self, t):
+        return {"secs": int(t), "nanos": int(t % 1 * 1e9),
+                "val": math.sin(t / 3600.0), "severity": 0, "status": 0}
+
+    def sample(self, at):
+        '''the last sample at or before time 'at' (see data())'''
+        step = 1.0 / self.rate
+        return self._sample(math.floor(_seconds(at) / step) * step)
+
+    def data(self, pv, start, end):
+        '''[{"meta", "data"}] with samples every 1/rate seconds'''
+        (t0, t1) = (_seconds(start), _seconds(end))
+        step = 1.0 / self.rate
+        t = math.floor(t0 / step) * step # AA also returns the sample before
+        samples = []
+        while t <= t1:
+            samples.append(self._sample(t))
+            t += step
+        return [{"meta": {"name": pv, "PREC": "0"}, "data": samples}]
+
+    def start(self):
+        self._thread = threading.Thread(target=self.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+def ramp(first=1, last=64, duration=30):
+    '''ramp profile: concurrency doubled from 'first' to 'last', 'duration'
+    seconds per stage, e.g. [(1, 30), (2, 30), (4, 30), ...]'''
+    stages, n = [], first
+    while n < last:
+        stages.append((n, duration))
+        n *= 2
+    stages.append((last, duration))
+    return stages
+
+
+def percentile(sorted_values, p):
+    '''nearest-rank percentile of sorted values'''
+    if not sorted_values:
+        return float('nan')
+    rank = int(math.ceil(p / 100.0 * len(sorted_values)))
+    return sorted_values[max(rank, 1) - 1]
+
+
+class LoadTest(object):
+    '''Run a mix of operations against an appliance.
+
+    :param client_factory: callable returning a new `ArchiverAppliance`
+    :param pvnames: pvs used by the data and status operations
+    :param start: start time of the data retrieved (string or datetime)
+    :param end: end time of the data retrieved (string or datetime)
+    :param mix: dict of operation (OPERATIONS) -> weight
+    :param window: length of retrieval windows as `datetime.timedelta`
+    :param bulk_size: number of pvs of the bulk operation
+    '''
+
+    def __init__(self, client_factory, pvnames, start, end, mix=None,
+                 window=timedelta(hours=1), bulk_size=500):
+        self.client_factory = client_factory
+        self.pvnames = list(pvnames)
+        self.start = start
+        self.end = end
+        self.window = window
+        self.bulk_size = bulk_size
+        mix = mix or {"data": 8, "status": 1, "report": 1}
+        unknown = set(mix) - set(OPERATIONS)
+        if unknown:
+            raise ValueError("unknown operations: {}".format(sorted(unknown)))
+        self.operations = [op for op in OPERATIONS if mix.get(op)]
+        self.weights = [mix[op] for op in self.operations]
+
+    def _pick(self, rng):
+        x = rng.uniform(0, sum(self.weights))
+        for (op, weight) in zip(self.operations, self.weights):
+            x -= weight
+            if x <= 0:
+                return op
+        return self.operations[-1]
+
+    def _call(self, client, op, rng):
+        pv = rng.choice(self.pvnames)
+        if op == "data":
+            span = max((self.end - self.start - self.window).total_seconds(), 0)
+            t0 = self.start + timedelta(seconds=rng.uniform(0, span))
+            client.get_data(pv, t0, t0 + self.window, return_type="arrays")
+        elif op == "status":
+            client.get_pv_status(pv)
+        elif op == "bulk":
+            client.get_pvs_status(rng.sample(self.pvnames,
+                                  min(self.bulk_size, len(self.pvnames))))
+        else:
+            getattr(client, rng.choice(REPORTS))()
+
+    def run_stage(self, concurrency, duration):
+        '''Run 'concurrency' workers for 'duration' seconds.
+
+        :return: list of (operation, latency in seconds, ok) tuples
+        '''
+        records, lock = [], threading.Lock()
+        deadline = time.time() + duration
+
+        def _worker(seed):
+            client = self.client_factory()
+            rng = random.Random(seed)
+            local = []
+            while time.time() < deadline:
+                op = self._pick(rng)
+                t = time.time()
+                try:
+                    self._call(client, op, rng)
+                    ok = True
+                except Exception:
+                    ok = False
+                local.append((op, time.time() - t, ok))
+            with lock:
+                records.extend(local)
+
+        threads = [threading.Thread(target=_worker, args=(i,))
+                   for i in range(concurrency)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return records
+
+    def run(self, profile):
+        '''Run the stages of 'profile' (a list of (concurrency, duration)).
+
+        :return: a list of summaries (see summarize()), one per stage
+        '''
+        self.start, self.end = utils.to_datetime(self.start), utils.to_datetime(self.end)
+        results = []
+        for (concurrency, duration) in profile:
+            records = self.run_stage(concurrency, duration)
+            summary = summarize(records, duration)
+            summary["concurrency"] = concurrency
+            print_summary(summary)
+            results.append(summary)
+        return results
+
+
+def summarize(records, duration):
+    '''throughput, errors and latency percentiles (ms) of a stage, overall and
+    per operation'''
+    def _stats(subset):
+        latencies = sorted(r[1] for r in subset)
+        result = odict([("requests", len(subset)),
+                        ("errors", sum(1 for r in subset if not r[2])),
+                        ("throughput", len(subset) / float(duration))])
+        for p in PERCENTILES:
+            result["p{}".format(p)] = percentile(latencies, p) * 1000
+        return result
+
+    summary = _stats(records)
+    summary["operations"] = odict((op, _stats([r for r in records if r[0] == op]))
+                                  for op in OPERATIONS
+                                  if any(r[0] == op for r in records))
+    return summary
+
+
+def print_summary(summary):
+    print("{:>4} clients: {:8.1f} req/s, {} requests, {} errors, p50 {:.1f} ms, \
+p95 {:.1f} ms, p99 {:.1f} ms".format(summary["concurrency"],
+        summary["throughput"], summary["requests"], summary["errors"],
+        summary["p50"], summary["p95"], summary["p99"]))
+    for (op, stats) in summary["operations"].items():
+        print("        {:>6}: {:8.1f} req/s, {} errors, p50 {:.1f} ms, p95 {:.1f} \
+ms, p99 {:.1f} ms".format(op, stats["throughput"], stats["errors"],
+            stats["p50"], stats["p95"], stats["p99"]))
+
+
+def _parse_mix(text):
+    '''"data=8,status=1" -> {"data": 8.0, "status": 1.0}'''
+    mix = {}
+    for item in text.split(','):
+        (op, _, weight) = item.partition('=')
+        mix[op.strip()] = float(weight or 1)
+    return mix
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Archiver Appliance load test")
+    parser.add_argument("--host", help="appliance hostname")
+    parser.add_argument("--port", type=int, default=17665,
+                        help="management port [17665]")
+    parser.add_argument("--stand-in", action="store_true",
+                        help="run against a local stand-in server")
+    parser.add_argument("--latency", type=float, default=0.0,
+                        help="stand-in server latency per request (s) [0]")
+    parser.add_argument("--pvs", help="file of pv names (one column) or a \
+comma separated list [stand-in pvs]")
+    parser.add_argument("--start", default=None,
+                        help="start of the retrieved data [end - 7 days]")
+    parser.add_argument("--end", default=None, help="end of the retrieved \
+data [now]")
+    parser.add_argument("--window", type=float, default=3600,
+                        help="retrieval window (s) [3600]")
+    parser.add_argument("--mix", default="data=8,status=1,report=1",
+                        help="operation weights (data, status, bulk, report) \
+[data=8,status=1,report=1]")
+    parser.add_argument("--ramp", default="1,2,4,8,16,32,64",
+                        help="concurrency of each stage [1,2,4,...,64]")
+    parser.add_argument("--duration", type=float, default=30,
+                        help="duration of each stage (s) [30]")
+    parser.add_argument("--json", help="also write the summaries to this file")
+    args = parser.parse_args(argv)
+
+    server = None
+    if args.stand_in:
+        server = StandInServer(latency=args.latency).start()
+        (host, port) = ('127.0.0.1', server.port)
+    elif args.host:
+        (host, port) = (args.host, args.port)
+    else:
+        parser.error("either --host or --stand-in is required")
+    if args.pvs and ',' not in args.pvs:
+        with open(args.pvs) as fd:
+            pvnames = [line.split()[0] for line in fd if line.strip()
+                       and not line.startswith('#')]
+    elif args.pvs:
+        pvnames = args.pvs.split(',')
+    elif server is not None:
+        pvnames = server.pvnames
+    else:
+        parser.error("--pvs is required with --host")
+
+    end = args.end or datetime.utcnow()
+    start = args.start or utils.to_datetime(end) - timedelta(days=7)
+    test = LoadTest(lambda: _archiver_appliance(host, port), pvnames, start,
+                    end, _parse_mix(args.mix), timedelta(seconds=args.window))
+    profile = [(int(n), args.duration) for n in args.ramp.split(',')]
+    try:
+        results = test.run(profile)
+    finally:
+        if server is not None:
+            server.stop()
+    if args.json:
+        with open(args.json, 'w') as fd:
+            json.dump(results, fd, indent=1)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
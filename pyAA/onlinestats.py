@@ -0,0 +1,239 @@
+# -*- coding: utf-8 -*-
+'''Streaming statistics of archived data with mergeable online accumulators.
+
+Archived data are consumed retrieval window by retrieval window; each window
+only updates a few accumulators and is then dropped, so computing statistics
+over years of 10 Hz data needs constant memory. The accumulators can be merged,
+which is how the partial results of parallel time slices are combined:
+    - Moments: count, min, max, mean and variance (Welford / Chan et al.);
+    - TDigest: a (vectorized) merging t-digest sketch for quantiles;
+    - TimeWeighted: time-weighted integral and average (each value is held
+      until the next sample, as the Archiver does).
+
+Packages required: numpy, pandas.
+'''
+
+from datetime import datetime, timedelta
+import numpy as np
+import pandas as pd
+import utils
+
+
+class Moments(object):
+    '''count, min, max, mean and variance'''
+
+    def __init__(self):
+        self.n = 0
+        self.mean = 0.0
+        self.m2 = 0.0 # sum of squares of differences from the mean
+        self.min = np.nan
+        self.max = np.nan
+
+    def _combine(self, n, mean, m2, vmin, vmax):
+        '''parallel variant of Welford's algorithm (Chan et al.)'''
+        if not n:
+            return
+        if not self.n:
+            (self.n, self.mean, self.m2, self.min, self.max) = \
+                (n, mean, m2, vmin, vmax)
+            return
+        total = self.n + n
+        delta = mean - self.mean
+        self.mean += delta * n / total
+        self.m2 += m2 + delta ** 2 * self.n * n / total
+        self.n = total
+        self.min = min(self.min, vmin)
+        self.max = max(self.max, vmax)
+
+    def update(self, values):
+        if len(values):
+            mean = values.mean()
+            self._combine(len(values), mean, ((values - mean) ** 2).sum(),
+                          values.min(), values.max())
+
+    def merge(self, other):
+        self._combine(other.n, other.mean, other.m2, other.min, other.max)
+
+    def result(self):
+        std = np.sqrt(self.m2 / (self.n - 1)) if self.n > 1 else np.nan
+        return {"count": self.n, "min": self.min, "max": self.max,
+                "mean": self.mean if self.n else np.nan, "std": std}
+
+
+class TDigest(object):
+    '''Merging t-digest: a bounded set of (mean, weight) centroids from which
+    quantiles are interpolated. 'delta' controls accuracy vs. size (about
+    delta/2 centroids); centroids are small at both tails (k1 scale function)
+    so extreme percentiles stay accurate.'''
+
+    def __init__(self, delta=100):
+        self.delta = delta
+        self.means = np.empty(0)
+        self.weights = np.empty(0)
+
+    def _compress(self, means, weights):
+        order = np.argsort(means, kind="mergesort")
+        means, weights = means[order], weights[order]
+        total = weights.sum()
+        if not total:
+            return
+        # k1 scale function of the quantile at the middle of each centroid;
+        # centroids falling into the same unit of k are merged together
+        q = (np.cumsum(weights) - weights / 2.0) / total
+        k = self.delta / (2 * np.pi) * np.arcsin(2 * q - 1)
+        cluster = np.floor(k - k[0]).astype(int)
+        w = np.bincount(cluster, weights=weights)
+        m = np.bincount(cluster, weights=weights * means)
+        keep = w > 0
+        self.means, self.weights = m[keep] / w[keep], w[keep]
+
+    def update(self, values):
+        if len(values):
+            self._compress(np.concatenate([self.means, values]),
+                    np.concatenate([self.weights, np.ones(len(values))]))
+
+    def merge(self, other):
+        self._compress(np.concatenate([self.means, other.means]),
+                       np.concatenate([self.weights, other.weights]))
+
+    def quantile(self, q):
+        '''q: a number (or an array) between 0 and 1'''
+        if not len(self.means):
+            return np.nan * np.asarray(q)
+        cum = np.cumsum(self.weights) - self.weights / 2.0
+        return np.interp(np.asarray(q) * self.weights.sum(), cum, self.means)
+
+
+class TimeWeighted(object):
+    '''Time-weighted integral of values: each value is held until the next
+    sample. Partial results have to be merged in time order.'''
+
+    def __init__(self):
+        self.integral = 0.0
+        self.duration = 0.0
+        self.first_t = None
+        self.last_t = None
+        self.last_v = None
+
+    def _bridge(self, t):
+        '''hold the last known value until time t'''
+        if self.last_t is not None:
+            self.integral += self.last_v * (t - self.last_t)
+            self.duration += t - self.last_t
+
+    def update(self, times, values):
+        '''times: sorted epoch seconds; values: values at these times'''
+        if not len(times):
+            return
+        self._bridge(times[0])
+        self.integral += (values[:-1] * np.diff(times)).sum()
+        self.duration += times[-1] - times[0]
+        if self.first_t is None:
+            self.first_t = times[0]
+        self.last_t, self.last_v = times[-1], values[-1]
+
+    def merge(self, other):
+        '''other: accumulator of a later time slice'''
+        if other.first_t is None:
+            return
+        self._bridge(other.first_t)
+        self.integral += other.integral
+        self.duration += other.duration
+        if self.first_t is None:
+            self.first_t = other.first_t
+        self.last_t, self.last_v = other.last_t, other.last_v
+
+    def result(self, end=None):
+        '''time-weighted average from the first sample to 'end' (epoch seconds,
+        default is the last sample)'''
+        integral, duration = self.integral, self.duration
+        if end is not None and self.last_t is not None and end > self.last_t:
+            integral += self.last_v * (end - self.last_t)
+            duration += end - self.last_t
+        if duration > 0:
+            return integral / duration
+        return self.last_v if self.last_v is not None else np.nan
+
+
+class PVStats(object):
+    '''All the accumulators of a pv (or of one time slice of a pv)'''
+
+    def __init__(self, delta=100):
+        self.moments = Moments()
+        self.digest = TDigest(delta)
+        self.time_weighted = TimeWeighted()
+
+    def update(self, df):
+        '''df: retrieval window as returned by ArchiverAppliance.get_data()'''
+        if not len(df):
+            return
+        # only numeric scalars: waveforms and strings are ignored
+        values = pd.to_numeric(df["val"], errors="coerce").values.astype(float)
+        times = df.index.values.astype("datetime64[ns]").astype(np.int64) * 1e-9
+        ok = ~np.isnan(values)
+        values, times = values[ok], times[ok]
+        self.moments.update(values)
+        self.digest.update(values)
+        self.time_weighted.update(times, values)
+
+    def merge(self, other):
+        self.moments.merge(other.moments)
+        self.digest.merge(other.digest)
+        self.time_weighted.merge(other.time_weighted)
+
+    def result(self, percentiles=(50, 95, 99), end=None):
+        result = self.moments.result()
+        quantiles = self.digest.quantile(np.asarray(percentiles) / 100.0)
+        for (p, value) in zip(percentiles, np.atleast_1d(quantiles)):
+            result["p{}".format(p)] = value
+        result["time_weighted_mean"] = self.time_weighted.result(end)
+        return result
+
+
+def _epoch(dt):
+    return (dt - datetime(1970, 1, 1)).total_seconds()
+
+
+def compute_stats(archiver, pvnames, start, end, percentiles=(50, 95, 99),
+                  chunk=timedelta(hours=1), slices=4, workers=8, delta=100):
+    '''Compute statistics of archived data without materializing the data.
+
+    Each pv's time range is split into 'slices' time slices; all (pv, slice)
+    jobs run in parallel, each of them consuming its slice 'chunk' by 'chunk',
+    then the partial results of each pv are merged in time order.
+
+    :param archiver: `ArchiverAppliance` object
+    :param pvnames: a list of pv names
+    :param start: start time. Can be a string or `datetime.datetime` object.
+    :param end: end time. Can be a string or `datetime.datetime` object.
+    :param percentiles: percentiles to estimate (t-digest)
+    :param chunk: retrieval window length as `datetime.timedelta` (or seconds)
+    :param slices: number of time slices per pv
+    :param workers: number of concurrent retrieval jobs
+    :param delta: t-digest compression (accuracy vs. memory)
+    :return: `pandas.DataFrame` indexed by pv with columns of count, min, max,
+             mean, std, p50, ..., time_weighted_mean
+    '''
+    start, end = utils.to_datetime(start), utils.to_datetime(end)
+    slice_length = max((end - start) // max(slices, 1), timedelta(seconds=1))
+    time_slices = list(utils.time_windows(start, end, slice_length))
+    jobs = [(pv, s0, s1) for pv in pvnames for (s0, s1) in time_slices]
+
+    def _worker(job):
+        (pv, s0, s1) = job
+        partial = PVStats(delta)
+        for (t0, t1) in utils.time_windows(s0, s1, chunk):
+            partial.update(archiver.get_window_data(pv, t0, t1,
+                                                    closed=(t1 >= end)))
+        return partial
+
+    partials = utils.map_concurrently(_worker, jobs, workers)
+
+    results = []
+    n = len(time_slices)
+    for (i, pv) in enumerate(pvnames):
+        merged = PVStats(delta)
+        for partial in partials[i * n:(i + 1) * n]: # in time order
+            merged.merge(partial)
+        results.append(merged.result(percentiles, end=_epoch(end)))
+    return pd.DataFrame(results, index=pd.Index(pvnames, name="pv"))
@@ -0,0 +1,321 @@
+# -*- coding: utf-8 -*-
+'''Buffered, structured report writers: CSV, JSON Lines and Parquet.
+
+Rows (dicts, or pv names) are written incrementally through a buffer, so a
+report of millions of rows can be streamed from a generator at disk speed.
+Every row of a report has the same columns (the schema): the columns given
+when the writer is created (e.g. union_columns() of a list of rows), or the
+keys of the first row; missing values are written as empty/null and keys
+which are not in the schema are dropped (with a warning), so reports streamed
+from a generator whose rows vary should declare their columns. A list of pv
+names is written with the single column "pvName".
+File info rows of aa._get_pvs_file_info() ({"pv(2018)": ..., "pv(total)": ...})
+are written as {"pvName": "pv", "2018": ..., "total": ...}.
+
+Formats (and file extensions):
+    - 'txt': the legacy tab separated "key<TAB>value<TAB>" text of aa._log;
+    - 'csv': header line and comma separated values (.csv);
+    - 'jsonl': one JSON object per line (.jsonl);
+    - 'parquet': columnar file (.parquet), requires pyarrow.
+Compression: 'gzip' (.gz) or 'bz2' (.bz2) for txt, csv and jsonl; for parquet
+the codec is passed to pyarrow ('snappy', 'gzip', 'zstd', ...; not 'bz2').
+'''
+
+from __future__ import print_function
+import io
+import abc
+import re
+import csv
+import bz2
+import sys
+import gzip
+import json
+from collections import OrderedDict as odict
+
+FORMATS = ("txt", "csv", "jsonl", "parquet")
+COMPRESSIONS = {"gzip": ".gz", "bz2": ".bz2"}
+PVNAME = "pvName"
+
+_PV_KEY = re.compile(r'^(.*)\(([^()]*)\)$')
+_PARTITION = re.compile(r'^\d{4}(_\d+)*$') # 2016, 2016_03, ...
+
+# base of abstract classes, for python 2 and 3
+_ABC = abc.ABCMeta('_ABC', (object,), {})
+
+
+def normalize_row(row):
+    '''{"pv(2018)": x, "pv(total)": y} -> {"pvName": "pv", "2018": x,
+    "total": y}; other dicts are returned as is, pv names as {"pvName": name}'''
+    if not isinstance(row, dict):
+        return odict([(PVNAME, row)])
+    matches = [_PV_KEY.match(str(key)) for key in row]
+    if not matches or not all(matches) or \
+            len(set(m.group(1) for m in matches)) != 1:
+        return row
+    result = odict([(PVNAME, matches[0].group(1))])
+    for (m, value) in zip(matches, row.values()):
+        result[m.group(2)] = value
+    return result
+
+
+def union_columns(rows):
+    '''columns of all rows (normalized, see normalize_row), in the order in
+    which they are first seen'''
+    columns = odict()
+    for row in rows:
+        for key in normalize_row(row):
+            columns[key] = None
+    return list(columns)
+
+
+def file_info_columns(rows):
+    '''columns of the rows of aa._get_pvs_file_info(): pvName, the sizes of
+    all partitions (years) found in any row in time order, then the others'''
+    columns = union_columns(rows)
+    partitions = sorted(c for c in columns if _PARTITION.match(str(c)))
+    return [PVNAME] + partitions + [c for c in columns
+                                    if c != PVNAME and c not in partitions]
+
+
+def _open_text(path, compression):
+    '''text file for writing, compressed or not, with a large buffer'''
+    if compression == "gzip":
+        raw = gzip.open(path, 'wb')
+    elif compression == "bz2":
+        raw = bz2.BZ2File(path, 'wb')
+    elif compression:
+        raise ValueError("compression should be one of {}".format(
+                         sorted(COMPRESSIONS)))
+    else:
+        raw = io.open(path, 'wb')
+    return io.TextIOWrapper(io.BufferedWriter(raw, 1024 * 1024),
+                            encoding='utf-8', newline='')
+
+
+def _text(value):
+    if value is None:
+        return u""
+    if isinstance(value, type(u"")):
+        return value
+    if isinstance(value, bytes):
+        return value.decode('utf-8', 'replace')
+    return type(u"")(value)
+
+
+class ReportWriter(_ABC):
+    '''Base class: buffers rows and hands them to _flush() in batches.
+
+    :param path: output file name (with its extension)
+    :param columns: schema of the report [default: keys of the first row]
+    :param buffer_rows: number of rows buffered before they are written
+    '''
+
+    def __init__(self, path, columns=None, compression=None, buffer_rows=10000):
+        self.path = path
+        self.columns = list(columns) if columns else None
+        self.compression = compression
+        self.buffer_rows = buffer_rows
+        self.rows = 0
+        self.dropped = set() # keys which are not in the schema
+        self._buffer = []
+        self._column_set = None
+        self._file_info = False # rows of aa._get_pvs_file_info()
+
+    def write(self, row):
+        if self._column_set is None: # first row
+            self._file_info = normalize_row(row) is not row
+            if self.columns is None: # the first row defines the schema
+                self.columns = list(normalize_row(row).keys())
+            self._column_set = set(self.columns)
+            self._start()
+        if not isinstance(row, dict) or self._file_info:
+            row = normalize_row(row)
+        if not self._column_set.issuperset(row):
+            self.dropped.update(set(row) - self._column_set)
+        self._buffer.append([row.get(column) for column in self.columns])
+        self.rows += 1
+        if len(self._buffer) >= self.buffer_rows:
+            self._flush(self._buffer)
+            self._buffer = []
+
+    def write_many(self, rows):
+        for row in rows:
+            self.write(row)
+        return self
+
+    def close(self):
+        if self._column_set is None: # no rows
+            self.columns = self.columns or [PVNAME]
+            self._start()
+        if self._buffer:
+            self._flush(self._buffer)
+            self._buffer = []
+        self._finish()
+        if self.dropped:
+            print("Warning: {} columns not in the schema of {} were dropped: {}"
+                  .format(len(self.dropped), self.path,
+                          ", ".join(sorted(map(str, self.dropped))[:10])),
+                  file=sys.stderr)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    # to be implemented by the formats
+    def _start(self):
+        pass
+
+    @abc.abstractmethod
+    def _flush(self, rows):
+        '''write a batch of rows (lists of values in the order of columns)'''
+
+    def _finish(self):
+        pass
+
+
+class TxtWriter(ReportWriter):
+    '''legacy aa._log format: pv names one per line; dicts as
+    "key<TAB>value<TAB>" (one line per row if one_line_per_pvinfo)'''
+
+    def __init__(self, path, columns=None, compression=None, buffer_rows=10000,
+                 one_line_per_pvinfo=True):
+        ReportWriter.__init__(self, path, columns, compression, buffer_rows)
+        self.one_line_per_pvinfo = one_line_per_pvinfo
+        self._fd = _open_text(path, compression)
+        self._raw = []
+
+    def write(self, row): # the legacy format keeps the original keys
+        self._raw.append(row)
+        self.rows += 1
+        if len(self._raw) >= self.buffer_rows:
+            self._flush(self._raw)
+            self._raw = []
+
+    def _flush(self, rows):
+        field_end = u"" if self.one_line_per_pvinfo else u"\n"
+        lines = []
+        for row in rows:
+            if isinstance(row, dict):
+                lines.append(u"".join(u"{}\t{}\t{}".format(_text(k), _text(v),
+                             field_end) for (k, v) in row.items()) + u"\n")
+            else:
+                lines.append(_text(row) + u"\n")
+        self._fd.write(u"".join(lines))
+
+    def close(self):
+        if self._raw:
+            self._flush(self._raw)
+            self._raw = []
+        self._fd.close()
+
+
+class CsvWriter(ReportWriter):
+
+    def _start(self):
+        if sys.version_info[0] < 3: # the py2 csv module writes utf-8 bytes
+            self._fd = self._open_binary()
+            self._cell = lambda value: _text(value).encode('utf-8')
+        else:
+            self._fd = _open_text(self.path, self.compression)
+            self._cell = _text
+        self._csv = csv.writer(self._fd, lineterminator='\n')
+        self._csv.writerow([self._cell(c) for c in self.columns])
+
+    def _open_binary(self):
+        if self.compression == "gzip":
+            return gzip.open(self.path, 'wb')
+        if self.compression == "bz2":
+            return bz2.BZ2File(self.path, 'wb')
+        return open(self.path, 'wb', 1024 * 1024)
+
+    def _flush(self, rows):
+        cell = self._cell
+        self._csv.writerows([[cell(v) for v in row] for row in rows])
+
+    def _finish(self):
+        self._fd.close()
+
+
+class JsonlWriter(ReportWriter):
+
+    def _start(self):
+        self._fd = _open_text(self.path, self.compression)
+
+    def _flush(self, rows):
+        columns = self.columns
+        self._fd.write(u"".join(_text(json.dumps(odict(zip(columns, row)),
+                                      default=str)) + u"\n" for row in rows))
+
+    def _finish(self):
+        self._fd.close()
+
+
+class ParquetWriter(ReportWriter):
+    '''the column types are inferred from the first batch (columns of None
+    only are strings); later batches are cast to them'''
+
+    def __init__(self, path, columns=None, compression=None, buffer_rows=100000):
+        if compression == "bz2":
+            raise ValueError("bz2 compression is not supported for parquet: "
+                             "use gzip, snappy or zstd")
+        import pyarrow # ImportError if pyarrow is not installed
+        ReportWriter.__init__(self, path, columns, compression, buffer_rows)
+        self._writer = None
+
+    def _flush(self, rows):
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+        data = odict((column, [row[i] for row in rows])
+                     for (i, column) in enumerate(self.columns))
+        if self._writer is None:
+            table = pa.Table.from_pydict(data)
+            schema = pa.schema([pa.field(f.name, pa.string()) if
+                                pa.types.is_null(f.type) else f
+                                for f in table.schema])
+            self._writer = pq.ParquetWriter(self.path, schema,
+                                            compression=self.compression or
+                                            "snappy")
+            self._schema = schema
+        self._writer.write_table(pa.Table.from_pydict(data, schema=self._schema))
+
+    def _finish(self):
+        if self._writer is None: # no rows: an empty table with the schema
+            self._flush([])
+        self._writer.close()
+
+
+WRITERS = {"txt": TxtWriter, "csv": CsvWriter, "jsonl": JsonlWriter,
+           "parquet": ParquetWriter}
+
+
+def extension(fmt, compression=None):
+    '''file extension of a format, e.g. .csv.gz'''
+    if fmt not in FORMATS:
+        raise ValueError("format should be one of {}".format(FORMATS))
+    if fmt == "parquet" or not compression:
+        return "." + fmt
+    return "." + fmt + COMPRESSIONS[compression]
+
+
+def open_writer(path, fmt="csv", columns=None, compression=None, **kwargs):
+    '''ReportWriter of format 'fmt' writing to path'''
+    if fmt not in FORMATS:
+        raise ValueError("format should be one of {}".format(FORMATS))
+    return WRITERS[fmt](path, columns=columns, compression=compression,
+                        **kwargs)
+
+
+def write_report(rows, path, fmt="csv", columns=None, compression=None,
+                 **kwargs):
+    '''Write rows (any iterable, e.g. a generator) to path.
+
+    :return: number of rows written
+    '''
+    writer = open_writer(path, fmt, columns, compression, **kwargs)
+    try:
+        writer.write_many(rows)
+    finally:
+        writer.close()
+    return writer.rows
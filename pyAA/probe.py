@@ -0,0 +1,199 @@
+# -*- coding: utf-8 -*-
+'''Batched Channel Access connectivity probing of (paused) PVs.
+
+A sweep over tens of thousands of paused PVs is split into batches of
+'batch_size' PVs; the channels of a batch connect concurrently and the batch
+gives up after 'timeout' seconds, so a sweep takes at most about
+len(pvnames) / batch_size * timeout seconds. Results are cached for 'ttl'
+seconds: PVs checked recently are not probed again. Reconnected PVs can be
+resumed in batches (one request per batch) with resume_pvs().
+
+Backends (the first installed one is used by default):
+    - 'cothread': cothread.catools.connect();
+    - 'pyepics': epics.ca channels created without waiting, then polled;
+    - 'fake': a set of online pv names (or a function), for tests.
+'''
+
+from __future__ import print_function
+import time
+import threading
+from collections import OrderedDict as odict
+import utils
+
+
+class CothreadBackend(object):
+    '''cothread is not thread safe: batches run one after the other'''
+    thread_safe = False
+
+    def __init__(self):
+        from cothread.catools import connect
+        self._connect = connect
+
+    def connect(self, pvnames, timeout):
+        '''return a dict: pv name -> True if it connected within timeout'''
+        results = self._connect(pvnames, cainfo=True, throw=False,
+                                timeout=timeout)
+        return dict((pvname, bool(result.ok))
+                    for (pvname, result) in zip(pvnames, results))
+
+
+class PyepicsBackend(object):
+    '''channels of a batch are created at once, then polled until all of them
+    are connected or the timeout expires'''
+    thread_safe = False
+
+    def __init__(self):
+        from epics import ca
+        self.ca = ca
+
+    def connect(self, pvnames, timeout):
+        ca = self.ca
+        chids = dict((pvname, ca.create_channel(pvname, connect=False,
+                                                auto_cb=False))
+                     for pvname in pvnames)
+        deadline = time.time() + timeout
+        pending = set(pvnames)
+        try:
+            while pending and time.time() < deadline:
+                ca.poll(evt=0.01)
+                pending = set(pv for pv in pending
+                              if not ca.isConnected(chids[pv]))
+        finally:
+            for chid in chids.values():
+                ca.clear_channel(chid)
+        return dict((pvname, pvname not in pending) for pvname in pvnames)
+
+
+class FakeBackend(object):
+    '''online: a set of pv names, or a function pv name -> bool'''
+    thread_safe = True
+
+    def __init__(self, online=(), delay=0.0):
+        self.online = online if callable(online) else set(online).__contains__
+        self.delay = delay
+        self.calls = 0
+
+    def connect(self, pvnames, timeout):
+        self.calls += 1
+        if self.delay:
+            time.sleep(min(self.delay, timeout))
+        return dict((pvname, bool(self.online(pvname))) for pvname in pvnames)
+
+
+# in order of preference
+BACKENDS = odict([("cothread", CothreadBackend), ("pyepics", PyepicsBackend),
+                  ("fake", FakeBackend)])
+
+
+def get_backend(name=None, **kwargs):
+    '''Create a backend.
+
+    :param name: one of BACKENDS; default is the first installed of
+                 'cothread' and 'pyepics'
+    '''
+    if name is not None:
+        if name not in BACKENDS:
+            raise ValueError("backend should be one of {}".format(list(BACKENDS)))
+        return BACKENDS[name](**kwargs)
+    for backend in ("cothread", "pyepics"):
+        try:
+            return BACKENDS[backend]()
+        except ImportError:
+            continue
+    raise ImportError("neither python-cothread nor pyepics is installed")
+
+
+class Prober(object):
+    '''Probe connectivity of PVs in bounded batches with a result cache.
+
+    :param backend: backend object or name (see BACKENDS)
+    :param batch_size: max number of channels connecting at the same time
+                       (per worker)
+    :param timeout: seconds to wait for the channels of a batch
+    :param ttl: seconds a result is cached
+    :param workers: number of concurrent batches (thread safe backends only)
+    '''
+
+    def __init__(self, backend=None, batch_size=1000, timeout=2.0, ttl=300,
+                 workers=4):
+        if backend is None or isinstance(backend, str):
+            backend = get_backend(backend)
+        self.backend = backend
+        self.batch_size = batch_size
+        self.timeout = timeout
+        self.ttl = ttl
+        self.workers = workers if backend.thread_safe else 1
+        self._cache = {} # pv name -> (time checked, connected)
+        self._lock = threading.Lock()
+
+    def _cached(self, pvnames, now):
+        with self._lock:
+            return dict((pv, self._cache[pv][1]) for pv in pvnames
+                        if pv in self._cache
+                        and now - self._cache[pv][0] < self.ttl)
+
+    def _probe_batch(self, batch):
+        try:
+            results = self.backend.connect(batch, self.timeout)
+        except Exception as e:
+            print("Failed to probe {} PVs: {}".format(len(batch), e))
+            return {} # not cached: probed again next time
+        now = time.time()
+        with self._lock:
+            for (pvname, ok) in results.items():
+                self._cache[pvname] = (now, ok)
+        return results
+
+    def probe(self, pvnames, debug=False):
+        '''Probe pvnames; recently checked PVs are taken from the cache.
+
+        :return: a dict: pv name -> True if connected (PVs of failed batches
+                 are missing)
+        '''
+        started = time.time()
+        results = self._cached(pvnames, started)
+        todo = [pv for pv in odict.fromkeys(pvnames) if pv not in results]
+        batches = [todo[i:i + self.batch_size]
+                   for i in range(0, len(todo), self.batch_size)]
+        if self.workers > 1 and len(batches) > 1:
+            for batch_results in utils.map_concurrently(self._probe_batch,
+                                                        batches, self.workers):
+                results.update(batch_results)
+        else:
+            for (i, batch) in enumerate(batches):
+                results.update(self._probe_batch(batch))
+                if debug:
+                    print("Probed {}/{} batches".format(i + 1, len(batches)))
+        if debug:
+            print("Probed {} PVs ({} cached) in {:.1f} s: {} connected".format(
+                len(pvnames), len(pvnames) - len(todo), time.time() - started,
+                sum(1 for ok in results.values() if ok)))
+        return results
+
+    def connected(self, pvnames, debug=False):
+        '''pv names (in the order of pvnames) which are connected'''
+        results = self.probe(pvnames, debug)
+        return [pv for pv in pvnames if results.get(pv)]
+
+
+def resume_pvs(archiver, pvnames, batch_size=100):
+    '''Resume pvnames, one request per batch of 'batch_size' PVs.
+
+    :return: a list of dicts with keys of pvName and status
+    '''
+    results = []
+    for i in range(0, len(pvnames), batch_size):
+        batch = pvnames[i:i + batch_size]
+        try:
+            result = archiver.resume_pv(",".join(batch))
+        except Exception as e:
+            result = [{"pvName": pv, "status": "failed", "validation": str(e)}
+                      for pv in batch]
+        if isinstance(result, dict): # a single pv
+            result = [result]
+        if not isinstance(result, list):
+            result = [{"pvName": pv, "status": str(result)} for pv in batch]
+        results.extend(result)
+        print("Resumed {}/{} PVs".format(min(i + batch_size, len(pvnames)),
+                                         len(pvnames)))
+    return results
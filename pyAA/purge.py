@@ -0,0 +1,165 @@
+# -*- coding: utf-8 -*-
+'''Planned, parallel deletion of archived data (.pb files) by year range.
+
+Instead of globbing the files of each PV and forking one "sudo rm" per file:
+    1) plan(): compute the full set of files to delete from one scan of the
+       LTS tree (see store.scan_pb_files);
+    2) print_summary(): show the number and size of files per year (dry-run);
+    3) pause_pvs(): pause PVs in batches (one request per batch), so that the
+       Archiver does not write the files being deleted;
+    4) delete_files(): delete the files of the paused PVs in parallel batches
+       through a single privileged helper process (sudo xargs -0 -P ... rm -f),
+       then remaining_files() checks which of them are still on disk;
+    5) delete_pvs(): delete from the Archiver, concurrently, only the PVs
+       whose files are verified gone (the others would leave untracked files);
+    6) write_manifest(): record what is planned before anything is deleted,
+       then what was done after each step, for auditing.
+'''
+
+from __future__ import print_function
+import os
+import json
+import subprocess
+from collections import OrderedDict as odict
+import store
+import utils
+
+
+def _year(pb_file):
+    '''year of a yearly partition: .../I:2016.pb -> 2016 (None otherwise)'''
+    partition = os.path.basename(pb_file).split(':')[1].split('.')[0]
+    try:
+        return int(partition.split('_')[0])
+    except ValueError:
+        return None
+
+
+def plan(pvnames, start_year, end_year, lts_path, lts_index=None):
+    '''Plan the deletion of the .pb files of pvnames from start_year to end_year.
+
+    :param pvnames: a list of pv names
+    :param lts_index: index built by store.scan_pb_files(lts_path); the LTS
+                      tree is scanned (once) if not given
+    :return: a dict with keys of
+        files: a list of dicts (pvName, year, path, size) of files to delete
+        pvnames: pvs to pause and delete from the Archiver (data files in
+                 range, or no data files at all)
+        out_of_range: pvs with data files, none of them in [start_year, end_year]
+    '''
+    if lts_index is None:
+        lts_index = store.scan_pb_files(lts_path)
+    result = {"files": [], "pvnames": [], "out_of_range": []}
+    for pvname in pvnames:
+        full_path = lts_path + '/' + store.pv_relative_path(pvname)
+        pb_files = lts_index.get(os.path.normpath(full_path), [])
+        in_range = [f for f in pb_files
+                    if start_year <= (_year(f) or -1) <= end_year]
+        if pb_files and not in_range:
+            result["out_of_range"].append(pvname)
+            continue
+        result["pvnames"].append(pvname)
+        for pb_file in in_range:
+            result["files"].append({"pvName": pvname, "year": _year(pb_file),
+                          "path": pb_file, "size": os.path.getsize(pb_file)})
+    return result
+
+
+def summary_by_year(files):
+    '''year -> (number of files, size in GB)'''
+    summary = odict()
+    for f in sorted(files, key=lambda f: f["year"]):
+        (count, size) = summary.get(f["year"], (0, 0.0))
+        summary[f["year"]] = (count + 1, size + f["size"] / 1024.0**3)
+    return summary
+
+
+def print_summary(the_plan):
+    '''dry-run: print the number and size of files to delete per year'''
+    total_files, total_GB = 0, 0.0
+    for (year, (count, size)) in summary_by_year(the_plan["files"]).items():
+        print("{}: {} files, {:.3f} GB".format(year, count, size))
+        total_files += count
+        total_GB += size
+    print("Total: {} files, {:.3f} GB of {} PVs; {} PVs without data in the \
+requested years are skipped.".format(total_files, total_GB,
+        len(the_plan["pvnames"]), len(the_plan["out_of_range"])))
+
+
+def delete_files(paths, batch_size=500, processes=4, use_sudo=True):
+    '''Delete files through a single privileged helper process: the paths are
+    fed to "xargs -0" which runs up to 'processes' "rm -f" in parallel, each of
+    them deleting up to 'batch_size' files.
+
+    :return: return code of the helper (0 if all files have been deleted)
+    '''
+    if not paths:
+        return 0
+    cmd = ['xargs', '-0', '-n', str(batch_size), '-P', str(processes),
+           'rm', '-f']
+    if use_sudo:
+        cmd = ['sudo'] + cmd
+    helper = subprocess.Popen(cmd, stdin=subprocess.PIPE)
+    helper.communicate(b"\0".join(p.encode('utf-8') if not isinstance(p, bytes)
+                                  else p for p in paths))
+    return helper.returncode
+
+
+def remaining_files(paths):
+    '''paths which are still on disk (e.g. after a failed delete_files())'''
+    return [p for p in paths if os.path.lexists(p)]
+
+
+def pause_pvs(archiver, pvnames, batch_size=100):
+    '''Pause pvnames, one request per batch of 'batch_size' PVs.
+
+    :return: the pv names which are not confirmed paused: the pvs of failed
+             requests, and the pvs whose status in the response is not "ok"
+             (or which are missing from the response)
+    '''
+    failed = []
+    for i in range(0, len(pvnames), batch_size):
+        batch = pvnames[i:i + batch_size]
+        try:
+            results = utils.results_by_pv(archiver.pause_pv(",".join(batch)))
+        except Exception as e:
+            print("Failed to pause {} PVs: {}".format(len(batch), e))
+            failed.extend(batch)
+            continue
+        not_paused = [pv for pv in batch if str(results.get(pv, {})
+                      .get("status", "")).lower() != "ok"]
+        if not_paused:
+            print("{} of {} PVs were not paused".format(len(not_paused),
+                                                        len(batch)))
+        failed.extend(not_paused)
+    return failed
+
+
+def delete_pvs(archiver, pvnames, workers=8):
+    '''Delete paused pvnames (their data files have already been deleted)
+    from the Archiver concurrently.
+
+    :return: a list of dicts with keys of pvName, status, etc.
+    '''
+    def _delete(pvname):
+        try:
+            result = archiver.delete_pv(pvname, delete_data=False)
+        except Exception as e:
+            result = {"status": "failed", "validation": str(e)}
+        if not isinstance(result, dict):
+            result = {"status": str(result)}
+        result["pvName"] = pvname
+        return result
+
+    return utils.map_concurrently(_delete, pvnames, workers)
+
+
+def write_manifest(filename, the_plan, **details):
+    '''record the plan and the results of a deletion for auditing; called
+    again at each step (with its 'state'), the file is replaced atomically'''
+    manifest = dict(details)
+    manifest.update(the_plan)
+    with open(filename + ".tmp", 'w') as fd:
+        json.dump(manifest, fd, indent=1, sort_keys=True)
+        fd.flush()
+        os.fsync(fd.fileno())
+    os.rename(filename + ".tmp", filename)
@@ -0,0 +1,173 @@
+# -*- coding: utf-8 -*-
+'''Data-quality scan of archived data: gaps, disconnects and stuck values.
+
+Data are retrieved window by window with get_data(return_type="numpy"), which
+keeps the severity and status of each sample (the DataFrame of get_data only
+keeps the values). Each window is checked with vectorized diffs and dropped;
+only a few counters and the last sample are carried to the next window:
+    - gaps: time between consecutive samples (or between the scanned time range
+      boundaries and the first/last sample) longer than 'max_gap';
+    - disconnects: transitions to INVALID severity, which the IOC or the
+      Archiver sets when a PV is disconnected; a sample with INVALID severity
+      is held until the next sample, which is counted as invalid time;
+    - stuck values: runs of identical values lasting at least 'stuck_time'.
+Downtime is the time covered by gaps or invalid samples: an invalid sample
+held across a gap is counted once. PVs are scanned in parallel and summarized
+in one table.
+
+Packages required: numpy, pandas.
+'''
+
+from datetime import datetime, timedelta
+import numpy as np
+import pandas as pd
+import utils
+
+INVALID = 3 # severity of an invalid / disconnected sample
+
+COLUMNS = ["samples", "gaps", "gap_time", "longest_gap", "disconnects",
+           "invalid_time", "stuck_runs", "stuck_time", "downtime", "error"]
+
+
+def _epoch(dt):
+    return (dt - datetime(1970, 1, 1)).total_seconds()
+
+
+def _changed(val):
+    '''True where a value differs from the previous one (len(val) - 1 items)'''
+    changed = val[1:] != val[:-1]
+    if changed.ndim > 1: # waveforms
+        changed = changed.reshape(len(changed), -1).any(axis=1)
+    return changed
+
+
+class PVQuality(object):
+    '''Quality counters of one pv, updated window by window in time order.'''
+
+    def __init__(self, start, max_gap=3600.0, stuck_time=86400.0):
+        self.start = start
+        self.max_gap = max_gap
+        self.stuck_time = stuck_time
+        self.samples = self.gaps = self.disconnects = self.stuck_runs = 0
+        self.gap_time = self.longest_gap = 0.0
+        self.invalid_time = self.stuck_time_total = 0.0
+        self.invalid_gap_time = 0.0 # invalid time which is gap time too
+        # carried from one window to the next
+        self.last = None # (t, val, severity) arrays of the last sample
+        self.last_t = start # start of the scan, then time of the last sample
+        self.run_start = None # start of the current run of identical values
+
+    def _gap(self, dt):
+        gaps = dt[dt > self.max_gap]
+        self.gaps += len(gaps)
+        self.gap_time += float(gaps.sum())
+        if len(gaps):
+            self.longest_gap = max(self.longest_gap, float(gaps.max()))
+
+    def _invalid(self, dt):
+        self.invalid_time += float(dt.sum())
+        self.invalid_gap_time += float(dt[dt > self.max_gap].sum())
+
+    def _stuck(self, durations):
+        stuck = durations[durations >= self.stuck_time]
+        self.stuck_runs += len(stuck)
+        self.stuck_time_total += float(stuck.sum())
+
+    def update(self, data):
+        '''data: numpy structured array (secs, nanos, val, severity, status) of
+        consecutive samples, after those of the previous update'''
+        if not len(data):
+            return
+        t = data["secs"] + data["nanos"] * 1e-9
+        (val, severity) = (data["val"], data["severity"])
+        self.samples += len(data)
+        if self.last is None: # first window: leading gap, no previous sample
+            self._gap(np.array([t[0] - self.last_t]))
+            self.run_start = t[0]
+        else:
+            t = np.concatenate([self.last[0], t])
+            val = np.concatenate([self.last[1], val])
+            severity = np.concatenate([self.last[2], severity])
+        dt = np.diff(t)
+        self._gap(dt)
+
+        invalid = severity == INVALID
+        self._invalid(dt[invalid[:-1]])
+        self.disconnects += int(np.count_nonzero(invalid[1:] & ~invalid[:-1]))
+        if self.last is None and invalid[0]:
+            self.disconnects += 1
+
+        # runs of identical values: they end where the value changes
+        ends = np.flatnonzero(_changed(val)) + 1
+        if len(ends):
+            starts = np.concatenate([[self.run_start], t[ends[:-1]]])
+            self._stuck(t[ends] - starts)
+            self.run_start = t[ends[-1]]
+        self.last = (t[-1:], val[-1:], severity[-1:])
+        self.last_t = t[-1]
+
+    def result(self, end):
+        '''summary, with the last sample held until 'end' (epoch seconds)'''
+        tail = np.array([end - self.last_t])
+        self._gap(tail)
+        if self.last is not None:
+            if self.last[2][0] == INVALID:
+                self._invalid(tail)
+            self._stuck(np.array([end - self.run_start]))
+        # union of the gaps and the invalid time, within the scanned range
+        downtime = self.gap_time + self.invalid_time - self.invalid_gap_time
+        downtime = min(max(downtime, 0.0), end - self.start)
+        return {"samples": self.samples, "gaps": self.gaps,
+                "gap_time": self.gap_time, "longest_gap": self.longest_gap,
+                "disconnects": self.disconnects,
+                "invalid_time": self.invalid_time,
+                "stuck_runs": self.stuck_runs,
+                "stuck_time": self.stuck_time_total,
+                "downtime": downtime, "error": ""}
+
+
+def scan_pv(archiver, pv, start, end, max_gap=3600.0, stuck_time=86400.0,
+            chunk=timedelta(days=1)):
+    '''Scan the archived data of one pv, 'chunk' by 'chunk'.
+
+    :return: a dict with keys of COLUMNS
+    '''
+    start, end = utils.to_datetime(start), utils.to_datetime(end)
+    quality = PVQuality(_epoch(start), max_gap, stuck_time)
+    for (t0, t1) in utils.time_windows(start, end, chunk):
+        data = archiver.get_data(pv, t0, t1, return_type="numpy")
+        # drop AA's sample before the window, and the next window's first one
+        secs = data["secs"] + data["nanos"] * 1e-9
+        inside = secs >= _epoch(t0)
+        if t1 < end:
+            inside &= secs < _epoch(t1)
+        quality.update(data[inside])
+    return quality.result(_epoch(end))
+
+
+def scan(archiver, pvnames, start, end, max_gap=3600.0, stuck_time=86400.0,
+         chunk=timedelta(days=1), workers=8):
+    '''Scan the archived data of many pvs in parallel.
+
+    :param archiver: `ArchiverAppliance` object
+    :param pvnames: a list of pv names
+    :param start: start time. Can be a string or `datetime.datetime` object.
+    :param end: end time. Can be a string or `datetime.datetime` object.
+    :param max_gap: shortest gap (seconds) between samples to be reported
+    :param stuck_time: shortest run (seconds) of identical values to be reported
+    :param chunk: retrieval window length as `datetime.timedelta` (or seconds)
+    :param workers: number of pvs scanned concurrently
+    :return: `pandas.DataFrame` indexed by pv with COLUMNS (times in seconds);
+             pvs which could not be scanned have a non-empty "error"
+    '''
+    def _worker(pv):
+        try:
+            return scan_pv(archiver, pv, start, end, max_gap, stuck_time, chunk)
+        except Exception as e:
+            result = dict((column, np.nan) for column in COLUMNS)
+            result["error"] = str(e)
+            return result
+
+    results = utils.map_concurrently(_worker, pvnames, workers)
+    return pd.DataFrame(results, index=pd.Index(pvnames, name="pv"),
+                        columns=COLUMNS)
@@ -0,0 +1,189 @@
+# -*- coding: utf-8 -*-
+'''Locate the archived data files (.pb) of PVs in a storage tier (e.g. LTS).
+
+pvname = "SR-RF{CFD:2-Cav}E:I"; relative_path = 'SR/RF/CFD/2/Cav/E/I';
+pb_file: lts_path/SR/RF/CFD/2/Cav/E/I:2016.pb.
+
+_get_pvs_file_info() in aa.py globs the files of each pv. For many pvs (or a
+long-lived process, see daemon.py) it is much cheaper to walk the storage tree
+once and build an index: scan_pb_files().
+
+The Archiver stores data in up to three tiers: short-term (STS), medium-term
+(MTS) and long-term (LTS), configured in aa.conf ([Sts], [Mts], [Lts] with a
+Path and a Granularity). A partition file of each tier covers 5/15/30 minutes,
+an hour, a day, a month or a year: pv:2016.pb, pv:2016_03.pb,
+pv:2016_03_14.pb, pv:2016_03_14_15.pb, pv:2016_03_14_15_05.pb.
+scan_tiers() walks all tiers in parallel (a pool of workers per tier) and
+tier_usage() reports the number and size of files per pv and tier.
+'''
+
+import os
+import re
+from collections import OrderedDict as odict
+import utils
+
+TIERS = ("Sts", "Mts", "Lts") # fastest first, as the aa.conf sections
+
+# partition granularities of the [Sts], [Mts] and [Lts] sections of aa.conf
+GRANULARITIES = ("5min", "15min", "30min", "hour", "day", "month", "year")
+
+
+def pv_relative_path(pvname):
+    '''replace the special characters, ':', '{', '}', '-', with '/'.
+    This is specific for NSLS-2.'''
+    return re.sub('[:{}-]', '/', pvname)
+    #return re.sub('[char_set]', '/', pvname)
+
+
+def _pb_entries(dirpath, filenames, with_size):
+    '''(prefix, pb_file or (pb_file, size)) of the .pb files of a directory'''
+    for filename in filenames:
+        if ':' not in filename or not filename.endswith('.pb'):
+            continue
+        pb_file = os.path.join(dirpath, filename)
+        prefix = os.path.normpath(os.path.join(dirpath, filename.split(':')[0]))
+        if with_size:
+            try:
+                pb_file = (pb_file, os.path.getsize(pb_file))
+            except OSError: # deleted meanwhile (e.g. ETL from STS to MTS)
+                continue
+        yield (prefix, pb_file)
+
+
+def _walk(top, with_size):
+    '''(prefix, pb_file or (pb_file, size)) of the .pb files under top'''
+    for (dirpath, dirnames, filenames) in os.walk(top):
+        for entry in _pb_entries(dirpath, filenames, with_size):
+            yield entry
+
+
+def _scan(path, workers, with_size):
+    '''index of 'path': the files of 'path' itself are listed, and its
+    top-level directories are walked by 'workers' threads (file system calls
+    release the GIL)'''
+    index = {}
+
+    def _add(entries):
+        for (prefix, entry) in entries:
+            index.setdefault(prefix, []).append(entry)
+
+    if workers > 1 and os.path.isdir(path):
+        names = sorted(os.listdir(path))
+        dirs = set(name for name in names
+                   if os.path.isdir(os.path.join(path, name)))
+        _add(_pb_entries(path, [name for name in names if name not in dirs],
+                         with_size))
+        # as os.walk(): links to directories are not followed
+        tops = [os.path.join(path, name) for name in names if name in dirs
+                and not os.path.islink(os.path.join(path, name))]
+        for entries in utils.map_concurrently(
+                lambda top: list(_walk(top, with_size)), tops, workers):
+            _add(entries)
+    else:
+        _add(_walk(path, with_size))
+    for files in index.values():
+        files.sort()
+    return index
+
+
+def scan_pb_files(path, workers=1):
+    '''Walk the storage tree 'path' once.
+
+    :param path: storage path, e.g. the [Lts] Path in aa.conf
+    :param workers: number of threads walking the top-level directories
+    :return: a dict: os.path.normpath(path/relative_path) -> sorted list of
+             its .pb files, i.e. the files of glob.glob(path/relative_path:*)
+    '''
+    return _scan(path, workers, with_size=False)
+
+
+def scan_tier(path, workers=8):
+    '''same as scan_pb_files(), with sizes: the values are sorted lists of
+    (pb_file, size in bytes)'''
+    return _scan(path, workers, with_size=True)
+
+
+def tiers_from_config(aaconfig_dict):
+    '''Storage tiers configured in aa.conf.
+
+    :param aaconfig_dict: dict of the aa.conf sections (see aa.py)
+    :return: an odict: tier (TIERS order) -> {"path", "granularity"}; the
+             granularity defaults to 'year' for LTS and '' (unknown) otherwise
+    '''
+    tiers = odict()
+    for tier in TIERS:
+        section = aaconfig_dict.get(tier)
+        if not section or not section.get("Path"):
+            continue
+        granularity = section.get("Granularity",
+                                  "year" if tier == "Lts" else "").lower()
+        if granularity and granularity not in GRANULARITIES:
+            raise ValueError("[{}] Granularity should be one of {}".format(
+                             tier, list(GRANULARITIES)))
+        tiers[tier] = {"path": str(section["Path"]), "granularity": granularity}
+    return tiers
+
+
+def scan_tiers(tiers, workers=8):
+    '''Scan all tiers at the same time, each with a pool of 'workers' threads.
+
+    :param tiers: see tiers_from_config()
+    :return: an odict: tier -> index (see scan_tier()); an empty index if the
+             path of a tier is not available
+    '''
+    def _scan_tier(tier):
+        path = tiers[tier]["path"]
+        return scan_tier(path, workers) if os.path.isdir(path) else {}
+
+    names = list(tiers)
+    return odict(zip(names, utils.map_concurrently(_scan_tier, names,
+                                                   len(names))))
+
+
+def partition(pb_file):
+    '''partition name of a .pb file: .../I:2016_03_14.pb -> 2016_03_14'''
+    return os.path.basename(pb_file).split(':', 1)[1].rsplit('.', 1)[0]
+
+
+def tier_usage(tiers, indexes, pvnames=None):
+    '''Number and size of the files of each pv in each tier.
+
+    :param tiers: see tiers_from_config()
+    :param indexes: see scan_tiers()
+    :param pvnames: a list of pv names; default is every file prefix found,
+                    reported by its path relative to the tier path
+    :return: a list of odicts with keys of pvName, tier, granularity, files,
+             size_GB, first and last (partitions), sorted by pvName and tier
+    '''
+    rows = []
+    for (tier, index) in indexes.items():
+        path = tiers[tier]["path"]
+        if pvnames is None:
+            keys = [(os.path.relpath(prefix, path), prefix) for prefix in index]
+        else:
+            keys = [(pvname, os.path.normpath(os.path.join(path,
+                     pv_relative_path(pvname)))) for pvname in pvnames]
+        for (name, prefix) in keys:
+            files = index.get(prefix, [])
+            if not files:
+                continue
+            rows.append(odict([("pvName", name), ("tier", tier),
+                ("granularity", tiers[tier]["granularity"]),
+                ("files", len(files)),
+                ("size_GB", sum(size for (f, size) in files) / 1024.0**3),
+                ("first", partition(files[0][0])),
+                ("last", partition(files[-1][0]))]))
+    order = dict((tier, i) for (i, tier) in enumerate(TIERS))
+    rows.sort(key=lambda row: (row["pvName"], order.get(row["tier"], 0)))
+    return rows
+
+
+def tier_totals(rows):
+    '''tier -> (number of pvs, number of files, size in GB) of tier_usage()'''
+    totals = odict()
+    for tier in TIERS:
+        tier_rows = [row for row in rows if row["tier"] == tier]
+        if tier_rows:
+            totals[tier] = (len(tier_rows), sum(r["files"] for r in tier_rows),
+                            sum(r["size_GB"] for r in tier_rows))
+    return totals
@@ -0,0 +1,130 @@
+# -*- coding: utf-8 -*-
+'''Overflow-driven sampling tuner.
+
+PVs reported by ArchiverAppliance.get_overflow_report() drop events because
+they update faster than their archival parameters allow. The tuner joins the
+overflow report, the event rate report and the PV type info (sampling period
+and method), proposes new archival parameters which reduce the write load on
+the appliance, and applies the approved proposals with batched, concurrent
+update_pv() calls.
+
+The sample buffer of a MONITOR PV is sized for one event per sampling period,
+so a MONITOR PV overflows when it updates faster than its sampling period.
+Rules (vectorized over all overflowing PVs):
+    1) MONITOR PVs are switched to 'method' (default SCAN), which archives at
+       most one sample per period, with a period derived from the observed
+       event rate: max(1/eventRate, 1/max_rate) seconds, i.e. every event is
+       kept up to max_rate events per second (PVs missing from the event rate
+       report get 1/max_rate);
+    2) other (SCAN) PVs get their sampling period multiplied by 'factor'.
+Proposed periods are rounded up to 1, 2, 5 x 10^n seconds.
+
+Packages required: numpy, pandas.
+'''
+
+from __future__ import print_function
+import numpy as np
+import pandas as pd
+import utils
+
+COLUMNS = ["pvName", "eventsDropped", "eventRate", "samplingMethod",
+           "samplingPeriod", "proposedMethod", "proposedPeriod"]
+
+
+def nice_ceil(periods):
+    '''round periods (seconds) up to 1, 2 or 5 x 10^n'''
+    periods = np.asarray(periods, dtype=float)
+    decade = 10.0 ** np.floor(np.log10(periods))
+    mantissa = periods / decade
+    nice = np.where(mantissa <= 1, 1, np.where(mantissa <= 2, 2,
+                    np.where(mantissa <= 5, 5, 10)))
+    return nice * decade
+
+
+def _get_type_infos(archiver, pvnames, workers=8):
+    '''PV type info (sampling period and method) of pvnames, concurrently'''
+    def _get(pvname):
+        try:
+            info = archiver.get_pv_type_info(pvname)
+        except Exception:
+            info = {}
+        return {"pvName": pvname, "samplingMethod": info.get("samplingMethod"),
+                "samplingPeriod": info.get("samplingPeriod")}
+    return utils.map_concurrently(_get, pvnames, workers)
+
+
+def propose(archiver, limit=1000, max_rate=1.0, factor=2.0, method="SCAN",
+            workers=8):
+    '''Propose new archival parameters for the PVs dropping events.
+
+    :param archiver: `ArchiverAppliance` object
+    :param limit: limit of the overflow and event rate reports
+    :param max_rate: max archived samples per second of PVs switched to 'method'
+    :param factor: multiplier of the sampling period of the SCAN PVs
+    :param method: new sampling method of the MONITOR PVs
+    :param workers: number of concurrent get_pv_type_info() calls
+    :return: `pandas.DataFrame` with COLUMNS, one row per overflowing PV
+    '''
+    overflow = pd.DataFrame(archiver.get_overflow_report(limit=limit))
+    if not len(overflow):
+        return pd.DataFrame(columns=COLUMNS)
+    rates = pd.DataFrame(archiver.get_event_rate_report(limit=limit),
+                         columns=["pvName", "eventRate"])
+    infos = pd.DataFrame(_get_type_infos(archiver, list(overflow["pvName"]),
+                                         workers))
+    df = overflow.merge(rates, on="pvName", how="left")
+    df = df.merge(infos, on="pvName", how="left")
+    for column in ("eventsDropped", "eventRate", "samplingPeriod"):
+        if column not in df:
+            df[column] = np.nan
+        df[column] = pd.to_numeric(df[column], errors="coerce")
+    # PVs without type info are skipped
+    df = df[df["samplingPeriod"] > 0].copy()
+
+    period = df["samplingPeriod"].values
+    rate = df["eventRate"].values
+    monitor = (df["samplingMethod"] == "MONITOR").values
+    with np.errstate(divide="ignore", invalid="ignore"):
+        event_period = np.where(rate > 0, 1.0 / rate, np.nan)
+    df["proposedMethod"] = np.where(monitor, method, df["samplingMethod"])
+    df["proposedPeriod"] = nice_ceil(np.where(monitor,
+                        np.fmax(event_period, 1.0 / max_rate), period * factor))
+    return df[COLUMNS].reset_index(drop=True)
+
+
+def print_diff(proposals):
+    '''dry-run: print the proposed changes'''
+    for row in proposals.itertuples(index=False):
+        print("{}: {} {}s -> {} {}s (event rate {:.3g}/s, {:.0f} dropped)"
+              .format(row.pvName, row.samplingMethod, row.samplingPeriod,
+                      row.proposedMethod, row.proposedPeriod, row.eventRate,
+                      row.eventsDropped))
+    print("{} PVs to be changed".format(len(proposals)))
+
+
+def apply(archiver, proposals, batch_size=100, workers=8):
+    '''Apply the proposals with update_pv(), 'batch_size' PVs at a time and
+    'workers' concurrent calls within a batch.
+
+    :return: a list of dicts with keys of pvName and status (and validation)
+    '''
+    def _update(row):
+        try:
+            result = archiver.update_pv(row.pvName, row.proposedPeriod,
+                                        row.proposedMethod)
+        except Exception as e:
+            result = {"status": "failed", "validation": str(e)}
+        if not isinstance(result, dict):
+            result = {"status": str(result)}
+        result["pvName"] = row.pvName
+        return result
+
+    rows = list(proposals.itertuples(index=False))
+    results = []
+    for i in range(0, len(rows), batch_size):
+        batch = utils.map_concurrently(_update, rows[i:i + batch_size], workers)
+        results.extend(batch)
+        failed = [r for r in batch if r.get("status") != "ok"]
+        print("Updated {}/{} PVs ({} failed)".format(len(results),
+                                                     len(rows), len(failed)))
+    return results
@@ -2,9 +2,79 @@
 """Utility functions"""
 import datetime
 import itertools
+import collections
+import contextlib
+import multiprocessing
 import sys
+from multiprocessing.pool import ThreadPool
 from dateutil import parser
 
+# timeout of the pool results: a blocking get() without timeout cannot be
+# interrupted by Ctrl-C in python 2
+WAIT_FOREVER = 10 ** 8
+
+
+def to_datetime(date_or_str):
+    """Return a naive `datetime.datetime` object (UTC is always assumed)
+
+    :param date_or_str: can be a datetime object or string
+    :return: `datetime.datetime` object
+    """
+    if not isinstance(date_or_str, datetime.datetime):
+        return parser.parse(date_or_str, ignoretz=True)
+    return date_or_str
+
+
+def time_windows(start, end, step):
+    """Split the time range [start, end) into consecutive windows
+
+    :param start: start time. Can be a string or `datetime.datetime` object.
+    :param end: end time. Can be a string or `datetime.datetime` object.
+    :param step: window length as `datetime.timedelta` (or seconds)
+    :return: generator of (window_start, window_end) datetime tuples
+    """
+    start, end = to_datetime(start), to_datetime(end)
+    if not isinstance(step, datetime.timedelta):
+        step = datetime.timedelta(seconds=step)
+    while start < end:
+        stop = min(start + step, end)
+        yield (start, stop)
+        start = stop
+
+
+@contextlib.contextmanager
+def worker_pool(workers, processes=False):
+    """Context manager of a pool of threads (or of processes)
+
+    The pool is closed and joined when the block ends normally. On an
+    exception (including KeyboardInterrupt) it is terminated: the tasks which
+    have not started are dropped instead of being waited for.
+
+    :param workers: number of threads (processes: None for the number of CPUs)
+    :param processes: if True, a `multiprocessing.Pool` is created
+    """
+    pool = multiprocessing.Pool(workers) if processes else ThreadPool(workers)
+    try:
+        yield pool
+    except BaseException:
+        pool.terminate()
+        pool.join()
+        raise
+    pool.close()
+    pool.join()
+
+
+def map_concurrently(func, items, workers, chunksize=1):
+    """Return [func(item) for item in items] computed by up to `workers`
+    threads (see worker_pool for the interruption)
+
+    :param items: iterable of the arguments of func
+    :param workers: max number of threads
+    """
+    items = list(items)
+    with worker_pool(max(1, min(workers, len(items)))) as pool:
+        return pool.map_async(func, items, chunksize).get(WAIT_FOREVER)
+
 
 def format_date(date_or_str):
     """Return a string representing the date and time in ISO 8601 format
@@ -14,10 +84,7 @@ def format_date(date_or_str):
                         Timezone is ignored. UTC is always assumed.
     :return: string in ISO 8601 format
     """
-    if not isinstance(date_or_str, datetime.datetime):
-        dt = parser.parse(date_or_str, ignoretz=True)
-    else:
-        dt = date_or_str
+    dt = to_datetime(date_or_str)
     try:
         return dt.isoformat(timespec="microseconds") + "Z"
     except:
@@ -58,13 +125,27 @@ def parse_rename_file(filename):
                 sys.stderr.write("Skipping: {}. Not enough values.\n".format(line))
 
 
+def iter_pvs_from_files(files, appliance=None):
+    """Return a generator of PV (as dict) from a list of files: the files are
+    parsed lazily, line by line"""
+    return itertools.chain.from_iterable(
+        parse_archive_file(filename, appliance) for filename in files
+    )
+
+
+def iter_pvnames_from_file(filename):
+    """Return a generator of PV names listed as one column in a file: empty
+    lines and lines starting with "#" are skipped"""
+    with open(filename, "r") as fd:
+        for line in fd:
+            line = line.strip()
+            if line and not line.startswith("#"):
+                yield line
+
+
 def get_pvs_from_files(files, appliance=None):
     """Return a list of PV (as dict) from a list of files"""
-    return list(
-        itertools.chain.from_iterable(
-            [parse_archive_file(filename, appliance) for filename in files]
-        )
-    )
+    return list(iter_pvs_from_files(files, appliance))
 
 
 def get_rename_pvs_from_files(files):
@@ -88,3 +169,54 @@ def check_result(result, default_message=None):
         sys.stderr.write("{}\n".format(message))
         return False
     return True
+
+
+def results_by_pv(result):
+    """Return a dict pv name -> result from the result of a request on one PV
+    (a dict) or on several PVs (a list of dicts with a "pvName" key)"""
+    if isinstance(result, dict):
+        result = [result]
+    return dict((r["pvName"], r) for r in result
+                if isinstance(r, dict) and "pvName" in r)
+
+
+def outcome(pv, new, status, message):
+    """One line of the report of ArchiverAppliance.rename_pvs"""
+    return {"pvName": pv, "newName": new, "outcome": status, "message": message}
+
+
+def validate_renames(pvs):
+    """Validate a list of (current, new) PV names before renaming them
+
+    Rejected: identical names, current or new names appearing more than once,
+    chains (the new name is the current name of another pair: the order of the
+    renames would matter) and cycles (pv1 -> pv2 -> pv1).
+
+    Return (valid pairs, report of the rejected pairs)
+    """
+    currents = collections.Counter(old for (old, new) in pvs)
+    news = collections.Counter(new for (old, new) in pvs)
+    mapping = dict(pvs)
+    valid, report = [], []
+    for (old, new) in pvs:
+        if old == new:
+            message = "Current and new names are the same"
+        elif currents[old] > 1:
+            message = "Duplicated current name"
+        elif news[new] > 1:
+            message = "Duplicated new name"
+        elif new in mapping:
+            # follow the renames: back to 'old' means a cycle
+            (seen, pv) = (set([old]), new)
+            while pv in mapping and pv not in seen:
+                seen.add(pv)
+                pv = mapping[pv]
+            if pv == old:
+                message = "Cycle of renames"
+            else:
+                message = "New name is renamed too (chain of renames)"
+        else:
+            valid.append((old, new))
+            continue
+        report.append(outcome(old, new, "skipped", message))
+    return (valid, report)
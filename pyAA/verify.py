@@ -0,0 +1,315 @@
+# -*- coding: utf-8 -*-
+'''Parallel integrity check of the archived data files (.pb) of a storage tree.
+
+Format of a .pb file (one partition of one pv): lines separated by '\n'; each
+line is a serialized protobuf message in which 0x1B, 0x0A ('\n') and 0x0D
+('\r') are escaped as 0x1B 0x01, 0x1B 0x02 and 0x1B 0x03. The first line is
+the PayloadInfo header (1: type, 2: pvname, 3: year, ...); the other lines are
+samples (1: secondsintoyear, 2: nano, 3: val, ...).
+
+verify_file() memory-maps a file and checks:
+    - framing: the file is not empty and ends with '\n', no empty lines, every
+      0x1B starts a valid escape sequence, no raw '\r';
+    - messages: the header and every sample are valid protobuf messages;
+    - header: the year of the header is the year of the file name;
+    - timestamps: samples are in increasing time order and inside the time
+      range of the partition of the file name (e.g. pv:2016_03.pb: March 2016).
+
+verify_tree() checks all files of a tree in a pool of processes. Each verified
+file is appended to out_dir/checkpoint.jsonl (with its size and modification
+time), so an interrupted run resumes where it stopped and files which have not
+changed are not read again. out_dir/bad_files.tsv lists the bad files.
+'''
+
+from __future__ import print_function
+import os
+import re
+import json
+import mmap
+import time
+import calendar
+from datetime import datetime
+import store
+import utils
+
+CHECKPOINT = "checkpoint.jsonl"
+REPORT = "bad_files.tsv"
+
+_BAD_ESCAPE = re.compile(b'\x1b(?![\x01\x02\x03])')
+
+
+def unescape(line):
+    '''original message bytes of an escaped line'''
+    if b'\x1b' not in line:
+        return line
+    return line.replace(b'\x1b\x02', b'\n').replace(b'\x1b\x03', b'\r') \
+               .replace(b'\x1b\x01', b'\x1b')
+
+
+def _varint(buf, pos):
+    '''(value, next position) of the varint at buf[pos] (buf: bytearray)'''
+    value, shift = 0, 0
+    while True:
+        if pos >= len(buf) or shift > 63:
+            raise ValueError("truncated varint")
+        byte = buf[pos]
+        value |= (byte & 0x7f) << shift
+        pos += 1
+        if not byte & 0x80:
+            return value, pos
+        shift += 7
+
+
+def parse_message(message):
+    '''dict: field number -> value (varints and bytes; the last value of a
+    repeated field) of a serialized protobuf message'''
+    buf = bytearray(message)
+    (fields, pos) = ({}, 0)
+    while pos < len(buf):
+        (key, pos) = _varint(buf, pos)
+        (number, wire_type) = (key >> 3, key & 7)
+        if wire_type == 0:
+            (value, pos) = _varint(buf, pos)
+        elif wire_type == 2:
+            (length, pos) = _varint(buf, pos)
+            value = bytes(buf[pos:pos + length])
+            pos += length
+        elif wire_type in (1, 5):
+            length = 8 if wire_type == 1 else 4
+            value = bytes(buf[pos:pos + length])
+            pos += length
+        else:
+            raise ValueError("invalid wire type {}".format(wire_type))
+        if number == 0 or pos > len(buf):
+            raise ValueError("truncated or invalid field {}".format(number))
+        fields[number] = value
+    return fields
+
+
+def partition_range(partition):
+    '''(year, first second, last second) of a partition name (seconds into the
+    year): 2016 -> the whole year; 2016_03 -> March; ...; 2016_03_14_15_05 ->
+    up to 30 minutes (5, 15 or 30 minute partitions)'''
+    parts = [int(p) for p in partition.split('_')]
+    year = parts[0]
+    start = datetime(*(parts + [1, 1][:max(0, 3 - len(parts))]))
+    if len(parts) == 1:
+        end = datetime(year + 1, 1, 1)
+    elif len(parts) == 2:
+        end = datetime(year + parts[1] // 12, parts[1] % 12 + 1, 1)
+    else:
+        span = {3: 86400, 4: 3600, 5: 1800}[len(parts)]
+        end = None
+    jan1 = calendar.timegm((year, 1, 1, 0, 0, 0))
+    first = calendar.timegm(start.timetuple()) - jan1
+    last = (calendar.timegm(end.timetuple()) - jan1 if end else first + span)
+    return year, first, last
+
+
+class _Errors(object):
+    '''error kind -> [count, first detail]'''
+
+    def __init__(self):
+        self.errors = {}
+
+    def add(self, kind, detail):
+        entry = self.errors.setdefault(kind, [0, detail])
+        entry[0] += 1
+
+
+def verify_file(path):
+    '''Check one .pb file (see the module documentation).
+
+    :return: a dict with keys of path, size, mtime, samples and errors (a dict:
+             error kind -> [count, first detail]; empty for a good file)
+    '''
+    errors = _Errors()
+    result = {"path": path, "samples": 0, "errors": errors.errors}
+    try:
+        stat = os.stat(path)
+    except OSError as e:
+        errors.add("unreadable", str(e))
+        return result
+    (result["size"], result["mtime"]) = (stat.st_size, stat.st_mtime)
+    if not stat.st_size:
+        errors.add("empty", "empty file")
+        return result
+    try:
+        bounds = partition_range(store.partition(path))
+    except (ValueError, KeyError, IndexError):
+        errors.add("filename", "unexpected partition name")
+        bounds = None
+
+    try:
+        fd = open(path, 'rb')
+    except (IOError, OSError) as e: # e.g. not readable by the pyAA user
+        errors.add("unreadable", str(e))
+        return result
+    with fd:
+        try:
+            mm = mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ)
+        except (IOError, OSError, ValueError) as e: # e.g. truncated by ETL
+            errors.add("unreadable", str(e))
+            return result
+        try:
+            _verify_lines(mm, min(stat.st_size, len(mm)), bounds, result,
+                          errors)
+        finally:
+            mm.close()
+    return result
+
+
+def _verify_lines(mm, size, bounds, result, errors):
+    if mm[size - 1:size] != b'\n':
+        errors.add("truncated", "no end of line at the end of the file")
+    (pos, number, previous) = (0, 0, None)
+    while pos < size:
+        end = mm.find(b'\n', pos)
+        if end < 0:
+            end = size
+        line = mm[pos:end]
+        number += 1
+        at = "line {} (offset {})".format(number, pos)
+        pos = end + 1
+        if not line:
+            errors.add("empty line", at)
+            continue
+        if b'\x1b' in line and _BAD_ESCAPE.search(line):
+            errors.add("bad escape", at)
+            continue
+        if b'\r' in line:
+            errors.add("raw carriage return", at)
+            continue
+        try:
+            fields = parse_message(unescape(line))
+        except ValueError as e:
+            errors.add("bad message", "{}: {}".format(at, e))
+            continue
+        if number == 1: # PayloadInfo
+            if 3 not in fields or 2 not in fields:
+                errors.add("bad header", "{}: no pvname or year".format(at))
+            elif bounds and fields[3] != bounds[0]:
+                errors.add("year mismatch", "header year {}, file name year {}"
+                           .format(fields[3], bounds[0]))
+            continue
+        result["samples"] += 1
+        stamp = (fields.get(1, 0), fields.get(2, 0))
+        if stamp[1] >= 1000000000:
+            errors.add("bad nano", "{}: nano {}".format(at, stamp[1]))
+        if bounds and not bounds[1] <= stamp[0] <= bounds[2]:
+            errors.add("out of partition", "{}: secondsintoyear {}"
+                       .format(at, stamp[0]))
+        if previous is not None and stamp < previous:
+            errors.add("not monotonic", "{}: {} after {}".format(at, stamp,
+                                                                  previous))
+        previous = stamp
+    if number < 2 and not errors.errors:
+        errors.add("no samples", "header only")
+
+
+class VerifyCheckpoint(object):
+    '''Append-only record of the verified files. A partially written last
+    line (interrupted run) is ignored.'''
+
+    def __init__(self, out_dir, sync_every=100):
+        self.path = os.path.join(out_dir, CHECKPOINT)
+        self.sync_every = sync_every
+        self.done = {} # path -> result
+        if os.path.isfile(self.path):
+            with open(self.path, 'r') as fd:
+                for line in fd:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        continue
+                    self.done[entry["path"]] = entry
+        self._fd = open(self.path, 'a')
+        self._pending = 0
+
+    def is_done(self, path):
+        '''True if path has been verified and has not changed since'''
+        entry = self.done.get(path)
+        if entry is None or "size" not in entry:
+            return False
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return False
+        return (stat.st_size, stat.st_mtime) == (entry["size"], entry["mtime"])
+
+    def mark_done(self, result):
+        self.done[result["path"]] = result
+        self._fd.write(json.dumps(result) + "\n")
+        self._pending += 1
+        if self._pending >= self.sync_every:
+            self.sync()
+
+    def sync(self):
+        self._fd.flush()
+        os.fsync(self._fd.fileno())
+        self._pending = 0
+
+    def close(self):
+        self.sync()
+        self._fd.close()
+
+
+def write_report(out_dir, results):
+    '''bad_files.tsv: path, error kind, count and first detail per line'''
+    path = os.path.join(out_dir, REPORT)
+    bad = 0
+    with open(path + ".tmp", 'w') as fd:
+        fd.write("path\terror\tcount\tfirst\n")
+        for result in sorted(results, key=lambda r: r["path"]):
+            if result["errors"]:
+                bad += 1
+            for (kind, (count, detail)) in sorted(result["errors"].items()):
+                fd.write("{}\t{}\t{}\t{}\n".format(result["path"], kind, count,
+                                                   detail))
+    os.rename(path + ".tmp", path)
+    return bad
+
+
+def verify_tree(path, out_dir, processes=None, resume=True, scan_workers=8):
+    '''Check all .pb files under 'path' in a pool of processes.
+
+    :param path: storage path, e.g. the [Lts] Path in aa.conf
+    :param out_dir: directory of the checkpoint and the report
+    :param processes: number of worker processes [default: number of CPUs]
+    :param resume: if False, files already verified are checked again
+    :param scan_workers: number of threads listing the files
+    :return: a dict with keys of files, checked (in this run), bad, samples
+             and report (path of bad_files.tsv)
+    '''
+    if not os.path.isdir(out_dir):
+        os.makedirs(out_dir)
+    if not resume and os.path.isfile(os.path.join(out_dir, CHECKPOINT)):
+        os.remove(os.path.join(out_dir, CHECKPOINT))
+    paths = sorted(f for files in store.scan_pb_files(path, scan_workers).values()
+                   for f in files)
+    checkpoint = VerifyCheckpoint(out_dir)
+    todo = [p for p in paths if not checkpoint.is_done(p)]
+    print("{} files under {}: {} to check".format(len(paths), path, len(todo)))
+
+    started = time.time()
+    try:
+        # interrupted: the pool is terminated first, then the checkpoint of
+        # the files already verified is flushed
+        with utils.worker_pool(processes, processes=True) as pool:
+            for (i, result) in enumerate(pool.imap_unordered(verify_file,
+                                                    todo, chunksize=16)):
+                checkpoint.mark_done(result)
+                if (i + 1) % 1000 == 0:
+                    print("Checked {}/{} files ({:.0f} files/s)".format(i + 1,
+                          len(todo), (i + 1) / (time.time() - started)))
+    finally:
+        checkpoint.close()
+
+    results = [checkpoint.done[p] for p in paths if p in checkpoint.done]
+    bad = write_report(out_dir, results)
+    summary = {"files": len(paths), "checked": len(todo), "bad": bad,
+               "samples": sum(r.get("samples", 0) for r in results),
+               "report": os.path.join(out_dir, REPORT)}
+    print("{files} files ({checked} checked in this run), {samples} samples: "
+          "{bad} bad files, see {report}".format(**summary))
+    return summary